@@ -0,0 +1,73 @@
+"""
+ File name   : benchmark.py
+ Description : Compare speed of inference backends (utils/backends.py) with eager PyTorch on a random input.
+               Outputs of every backend are checked against eager ones.
+"""
+
+import argparse
+import time
+
+import torch
+
+from detect import build_net
+from utils.backends import BACKENDS
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Retinaface backends benchmark')
+    parser.add_argument('-m', '--trained_model', default='./Resnet50_Final.pth', type=str)
+    parser.add_argument('--network', default='resnet50', help='Backbone network mobile0.25 or resnet50')
+    parser.add_argument('--onnx_model', default='FaceDetector.onnx', type=str,
+                        help='Model exported by convert_to_onnx.py, <onnx> backend is skipped if it is missing')
+    parser.add_argument('--backends', nargs='+', default=list(BACKENDS), choices=BACKENDS)
+    parser.add_argument('--height', default=1080, type=int)
+    parser.add_argument('--width', default=1920, type=int)
+    parser.add_argument('--batch_size', default=1, type=int)
+    parser.add_argument('--runs', default=10, type=int)
+    parser.add_argument('--warmup', default=2, type=int)
+    parser.add_argument('--threads', default=0, type=int, help='Number of CPU threads, 0 - default')
+    args = parser.parse_args()
+    args.cpu = True
+    return args
+
+
+def bench(net, img, runs: int, warmup: int) -> float:
+    """ Seconds per forward pass. """
+    for _ in range(warmup):
+        net(img)
+    tic = time.time()
+    for _ in range(runs):
+        net(img)
+    return (time.time() - tic) / runs
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+
+    torch.set_grad_enabled(False)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    img = torch.randn(args.batch_size, 3, args.height, args.width) * 50
+    reference = None
+    results = []
+    for backend in ['eager'] + [b for b in args.backends if b != 'eager']:
+        args.backend = backend
+        try:
+            net, _, _ = build_net(args)
+        except Exception as e:  # e.g. onnxruntime or exported model are missing
+            print(f"{backend}: skipped ({e})")
+            continue
+
+        outputs = net(img)
+        if reference is None:
+            reference = outputs
+        diff = max(float((out - ref).abs().max()) for out, ref in zip(outputs, reference))
+        results.append((backend, bench(net, img, args.runs, args.warmup), diff))
+
+    eager_time = results[0][1]
+    print(f"\n{args.batch_size}x3x{args.height}x{args.width}, {torch.get_num_threads()} threads")
+    print(f"{'backend':<12} {'ms/batch':>10} {'img/s':>8} {'speedup':>8} {'max diff':>10}")
+    for backend, seconds, diff in results:
+        print(f"{backend:<12} {seconds * 1000:>10.1f} {args.batch_size / seconds:>8.2f} "
+              f"{eager_time / seconds:>7.2f}x {diff:>10.2e}")
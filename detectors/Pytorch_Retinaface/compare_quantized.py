@@ -0,0 +1,45 @@
+"""
+ File name   : compare_quantized.py
+ Description : Report speed and detections of the INT8 ONNX model (convert_to_onnx.py --quantize) against fp32 one
+               on the same images, both run by detect.py pipeline with <onnx> backend.
+"""
+
+import argparse
+
+import torch
+
+from detect import build_net, detect, list_images
+from utils.quantization import compare_models
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Compare quantized Retinaface with fp32 one')
+    parser.add_argument('--fp32', default='FaceDetector.onnx', type=str, help='fp32 model exported by convert_to_onnx.py')
+    parser.add_argument('--int8', default='FaceDetector_int8.onnx', type=str, help='Quantized model')
+    parser.add_argument('-i', '--input', type=str, help='Folder or .txt list of images')
+    parser.add_argument('--limit', default=100, type=int, help='Number of images to compare on')
+    parser.add_argument('--network', default='resnet50', help='Backbone network mobile0.25 or resnet50')
+    parser.add_argument('--threads', default=0, type=int, help='Number of onnxruntime intra-op threads, 0 - default')
+    parser.add_argument('--confidence_threshold', default=0.2, type=float)
+    parser.add_argument('--top_k', default=5000, type=int)
+    parser.add_argument('--nms_threshold', default=0.4, type=float)
+    parser.add_argument('--keep_top_k', default=750, type=int)
+    parser.add_argument('--iou', default=0.5, type=float, help='IoU to match detections of the models')
+    args = parser.parse_args()
+    args.cpu, args.backend = True, 'onnx'
+    return args
+
+
+def _detector(args, model_path):
+    args = argparse.Namespace(**vars(args))
+    args.onnx_model = model_path
+    net, cfg, device = build_net(args)
+    return lambda img: detect(net, cfg, device, img, args)[0]
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    torch.set_grad_enabled(False)
+
+    detectors = {'fp32': _detector(args, args.fp32), 'int8': _detector(args, args.int8)}
+    compare_models(detectors, list_images(args.input)[:args.limit], args.iou)
@@ -17,7 +17,16 @@ parser = argparse.ArgumentParser(description='Test')
 parser.add_argument('-m', '--trained_model', default='./weights/mobilenet0.25_Final.pth',
                     type=str, help='Trained state_dict file path to open')
 parser.add_argument('--network', default='mobile0.25', help='Backbone network mobile0.25 or resnet50')
-parser.add_argument('--long_side', default=640, help='when origin_size is false, long_side is scaled size(320 or 640 for long side)')
+parser.add_argument('--long_side', default=640, type=int, help='when origin_size is false, long_side is scaled size(320 or 640 for long side)')
+parser.add_argument('-o', '--output', default='FaceDetector.onnx', type=str, help='Path of exported model')
+parser.add_argument('--static', action="store_true", default=False,
+                    help='Export for fixed <long_side>x<long_side> input. By default batch and image size are dynamic, '
+                         'as detect.py --backend onnx needs')
+parser.add_argument('--opset', default=11, type=int, help='ONNX opset version')
+parser.add_argument('--quantize', default=None, choices=['dynamic', 'static'],
+                    help='Also save INT8 model (<output>_int8.onnx): dynamic or static calibrated on <calib_images>')
+parser.add_argument('--calib_images', default=None, type=str, help='Folder with sample images for static calibration')
+parser.add_argument('--calib_count', default=100, type=int, help='Number of images used for calibration')
 parser.add_argument('--cpu', action="store_true", default=True, help='Use cpu inference')
 
 args = parser.parse_args()
@@ -76,13 +85,31 @@ if __name__ == '__main__':
     net = net.to(device)
 
     # ------------------------ export -----------------------------
-    output_onnx = 'FaceDetector.onnx'
+    output_onnx = args.output
     print("==> Exporting model to ONNX format at '{}'".format(output_onnx))
     input_names = ["input0"]
-    output_names = ["output0"]
+    output_names = ["loc", "conf", "landms"]
+    dynamic_axes = None
+    if not args.static:
+        dynamic_axes = {"input0": {0: "batch", 2: "height", 3: "width"}}
+        dynamic_axes.update({name: {0: "batch", 1: "priors"} for name in output_names})
     inputs = torch.randn(1, 3, args.long_side, args.long_side).to(device)
 
     torch_out = torch.onnx._export(net, inputs, output_onnx, export_params=True, verbose=False,
-                                   input_names=input_names, output_names=output_names)
+                                   input_names=input_names, output_names=output_names,
+                                   dynamic_axes=dynamic_axes, opset_version=args.opset)
+
+    # ------------------------ quantization -----------------------------
+    if args.quantize:
+        from utils.quantization import ImageCalibrationReader, letterbox_blob, list_sample_images, quantize_model
+
+        calibration = None
+        if args.quantize == 'static':
+            img_paths = list_sample_images(args.calib_images, args.calib_count) if args.calib_images else []
+            if not img_paths:
+                raise ValueError("Set <calib_images> folder with images for static quantization!!!")
+            calibration = ImageCalibrationReader(img_paths, input_names[0],
+                                                 lambda img: letterbox_blob(img, args.long_side))
+        quantize_model(output_onnx, output_onnx.replace('.onnx', '') + '_int8.onnx', args.quantize, calibration)
 
 
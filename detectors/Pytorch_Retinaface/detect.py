@@ -10,8 +10,13 @@ from utils.nms.py_cpu_nms import py_cpu_nms
 import cv2
 from models.retinaface import RetinaFace
 from utils.box_utils import decode, decode_landm
-import time
+from utils.worker import check_visible, serve
+from utils.frames import read_frames
+from utils.dets import DetsWriter
+from utils.prefetch import AsyncWriter, prefetch
+from utils.backends import BACKENDS, make_backend
 import glob
+from math import ceil
 from tqdm import tqdm
 
 def check_keys(model, pretrained_state_dict):
@@ -59,8 +64,25 @@ def _parse_args():
 
     parser.add_argument('-i', '--input', type=str)
     parser.add_argument('-s', '--save_path', type=str, default='./')
+    parser.add_argument('--frames', type=str, default=None,
+                        help='Read decoded images of <input> from the shared frame ring in the given folder')
+    parser.add_argument('--serve', type=str, default=None,
+                        help='Run as long-lived worker listening on the given Unix socket path')
 
     parser.add_argument('--cpu', action="store_true", default=False, help='Use cpu inference')
+    parser.add_argument('--threads', default=0, type=int, help='Number of CPU threads, 0 - torch default')
+    parser.add_argument('--backend', default='eager', choices=BACKENDS,
+                        help='eager - PyTorch module, torchscript - Conv-BN fused frozen trace, onnx - onnxruntime (CPU)')
+    parser.add_argument('--onnx_model', default='FaceDetector.onnx', type=str,
+                        help='Model exported by convert_to_onnx.py for <onnx> backend')
+    parser.add_argument('--batch_size', default=1, type=int, help='Number of images of similar size in one forward pass')
+    parser.add_argument('--bucket_step', default=64, type=int,
+                        help='Images are batched together if their sizes rounded up to <bucket_step> are the same')
+    parser.add_argument('--max_buckets', default=8, type=int,
+                        help='Number of not full buckets kept in memory, the oldest one is run when there are more')
+    parser.add_argument('--loaders', default=2, type=int,
+                        help='Number of threads decoding and preprocessing images ahead of inference, 0 - in the main thread')
+    parser.add_argument('--prefetch', default=4, type=int, help='Number of images loaded ahead of inference')
     parser.add_argument('--confidence_threshold', default=0.02, type=float, help='confidence_threshold')
     parser.add_argument('--top_k', default=5000, type=int, help='top_k')
     parser.add_argument('--nms_threshold', default=0.4, type=float, help='nms_threshold')
@@ -70,141 +92,215 @@ def _parse_args():
     args = parser.parse_args()
     return args
 
-if __name__ == '__main__':
-    args = _parse_args()
 
-    torch.set_grad_enabled(False)
+def build_net(args):
     cfg = None
     if args.network == "mobile0.25":
         cfg = cfg_mnet
     elif args.network == "resnet50":
         cfg = cfg_re50
+    device = torch.device("cpu" if args.cpu else "cuda")
+    if args.backend == 'onnx':  # weights are in the exported model
+        return make_backend(args.backend, None, device, args.onnx_model, args.threads), cfg, device
     # net and model
     net = RetinaFace(cfg=cfg, phase = 'test')
     net = load_model(net, args.trained_model, args.cpu)
     net.eval()
     print('Finished loading model!')
     cudnn.benchmark = True
-    device = torch.device("cpu" if args.cpu else "cuda")
     net = net.to(device)
+    return make_backend(args.backend, net, device), cfg, device
 
-    resize = 1
 
+def list_images(input_path):
+    if input_path.split('.')[-1] in ('jpg', 'png'):
+        img_paths = [input_path]
+    elif input_path.endswith('.txt'):
+        with open(input_path) as f:
+            img_paths = [line.strip() for line in f if line.strip()]
+    else:
+        img_paths = glob.glob(f"{input_path}/**/*.jpg", recursive=True)
+        img_paths.extend(  glob.glob(f"{input_path}/**/*.png", recursive=True) )
+    return img_paths
+
+
+def bucket_batches(images, batch_size, step, max_buckets):
+    """
+    Group (path, ..., [3, h, w] input) tuples into batches of images whose sizes rounded up to <step> are the same.
+    A bucket is yielded when it is full; if more than <max_buckets> buckets are waiting, the oldest one is yielded.
+    """
+    buckets = dict()
+    for item in images:
+        height, width = item[-1].shape[-2:]
+        key = (ceil(height / step), ceil(width / step))
+        bucket = buckets.setdefault(key, [])
+        bucket.append(item)
+        if len(bucket) >= batch_size:
+            yield buckets.pop(key)
+        elif len(buckets) > max_buckets:
+            yield buckets.pop(next(iter(buckets)))
+    yield from buckets.values()
+
+
+def detect(net, cfg, device, img_raw, args):
+    return detect_batch(net, cfg, device, [img_raw], args)[0]
+
+
+def preprocess(img_raw):
+    """ [3, h, w] input of the net: BGR image minus mean color. """
+    img = np.float32(img_raw)
+    img -= (104, 117, 123)
+    return np.ascontiguousarray(img.transpose(2, 0, 1))
+
+
+def detect_batch(net, cfg, device, imgs_raw, args):
+    return detect_preprocessed(net, cfg, device, [preprocess(img_raw) for img_raw in imgs_raw], args)
+
+
+def detect_preprocessed(net, cfg, device, imgs, args):
+    """ Inputs (preprocess) are padded at the bottom-right to the biggest of them, so detections need no shift. """
+    im_height = max(img.shape[1] for img in imgs)
+    im_width = max(img.shape[2] for img in imgs)
+
+    if len(imgs) == 1:
+        batch = imgs[0][np.newaxis]
+    else:
+        # padding is zero after mean subtraction, as if it was filled with mean color
+        batch = np.zeros((len(imgs), 3, im_height, im_width), dtype=np.float32)
+        for i, img in enumerate(imgs):
+            batch[i, :, :img.shape[1], :img.shape[2]] = img
+    img = torch.from_numpy(batch).to(device)
+
+    loc, conf, landms = net(img)  # forward pass
+
+    priorbox = PriorBox(cfg, image_size=(im_height, im_width))
+    priors = priorbox.forward()
+    priors = priors.to(device)
+    return [postprocess(loc[i], conf[i], landms[i], priors, cfg, device, im_height, im_width, args)
+            for i in range(len(imgs))]
 
-    if args.input.split('.')[-1] in ('jpg', 'png'):
-        img_paths = [args.input]
+
+def postprocess(loc, conf, landms, priors, cfg, device, im_height, im_width, args):
+    resize = 1
+
+    # ignore low scores and keep top-K before decoding: only a few priors pass the threshold
+    scores = conf.data[:, 1]
+    inds = torch.nonzero(scores > args.confidence_threshold).squeeze(1)
+    scores, order = scores[inds].sort(descending=True)
+    inds = inds[order[:args.top_k]]
+    scores = scores[:args.top_k].cpu().numpy()
+
+    scale = torch.Tensor([im_width, im_height, im_width, im_height])
+    scale = scale.to(device)
+    prior_data = priors.data[inds]
+    boxes = decode(loc.data[inds], prior_data, cfg['variance'])
+    boxes = boxes * scale / resize
+    boxes = boxes.cpu().numpy()
+    landms = decode_landm(landms.data[inds], prior_data, cfg['variance'])
+    scale1 = torch.Tensor([im_width, im_height, im_width, im_height,
+                           im_width, im_height, im_width, im_height,
+                           im_width, im_height])
+    scale1 = scale1.to(device)
+    landms = landms * scale1 / resize
+    landms = landms.cpu().numpy()
+
+    # do NMS
+    dets = np.hstack((boxes, scores[:, np.newaxis])).astype(np.float32, copy=False)
+    keep = py_cpu_nms(dets, args.nms_threshold)
+    # keep = nms(dets, args.nms_threshold,force_cpu=args.cpu)
+    dets = dets[keep, :]
+    landms = landms[keep]
+
+    # keep top-K faster NMS
+    dets = dets[:args.keep_top_k, :]
+    landms = landms[:args.keep_top_k, :]
+    return dets, landms
+
+
+def draw(img_raw, dets, landms, args):
+    dets = np.concatenate((dets, landms), axis=1)
+    for b in dets:
+        if b[4] < args.vis_thres:
+            continue
+        text = "{:.4f}".format(b[4])
+        b = list(map(int, b))
+        cv2.rectangle(img_raw, (b[0], b[1]), (b[2], b[3]), (0, 0, 255), 2)
+        cx = b[0]
+        cy = b[1] + 12
+        cv2.putText(img_raw, text, (cx, cy),
+                    cv2.FONT_HERSHEY_DUPLEX, 0.5, (255, 255, 255))
+
+        # landms
+        cv2.circle(img_raw, (b[5], b[6]), 1, (0, 0, 255), 4)
+        cv2.circle(img_raw, (b[7], b[8]), 1, (0, 255, 255), 4)
+        cv2.circle(img_raw, (b[9], b[10]), 1, (255, 0, 255), 4)
+        cv2.circle(img_raw, (b[11], b[12]), 1, (0, 255, 0), 4)
+        cv2.circle(img_raw, (b[13], b[14]), 1, (255, 0, 0), 4)
+    # save image
+
+    name = "test.jpg"
+    cv2.imwrite(name, img_raw)
+
+
+
+def run(net, cfg, device, input_path, save_path, args, frames=None) -> int:
+    img_paths = list_images(input_path)
+    os.makedirs(save_path, exist_ok=True)
+
+    if frames:  # images are already decoded by run.py
+        # frames of the ring are valid only until the next one is read, loaders work on copies
+        images = ((p, img.copy()) for p, img in read_frames(frames, img_paths, save_path))
     else:
-        img_paths = glob.glob(f"{args.input}/**/*.jpg", recursive=True)
-        img_paths.extend(  glob.glob(f"{args.input}/**/*.png", recursive=True) )
-
-    os.makedirs(args.save_path, exist_ok=True)
-
-    output = dict()
-
-    # testing begin
-    for image_path in tqdm(img_paths):
-        img_raw = cv2.imread(image_path, cv2.IMREAD_COLOR)
-
-        img = np.float32(img_raw)
-
-        im_height, im_width, _ = img.shape
-        scale = torch.Tensor([img.shape[1], img.shape[0], img.shape[1], img.shape[0]])
-        img -= (104, 117, 123)
-        img = img.transpose(2, 0, 1)
-        img = torch.from_numpy(img).unsqueeze(0)
-        img = img.to(device)
-        scale = scale.to(device)
-
-        tic = time.time()
-        loc, conf, landms = net(img)  # forward pass
-
-        priorbox = PriorBox(cfg, image_size=(im_height, im_width))
-        priors = priorbox.forward()
-        priors = priors.to(device)
-        prior_data = priors.data
-        boxes = decode(loc.data.squeeze(0), prior_data, cfg['variance'])
-        boxes = boxes * scale / resize
-        boxes = boxes.cpu().numpy()
-        scores = conf.squeeze(0).data.cpu().numpy()[:, 1]
-        landms = decode_landm(landms.data.squeeze(0), prior_data, cfg['variance'])
-        scale1 = torch.Tensor([img.shape[3], img.shape[2], img.shape[3], img.shape[2],
-                               img.shape[3], img.shape[2], img.shape[3], img.shape[2],
-                               img.shape[3], img.shape[2]])
-        scale1 = scale1.to(device)
-        landms = landms * scale1 / resize
-        landms = landms.cpu().numpy()
-
-        # ignore low scores
-        inds = np.where(scores > args.confidence_threshold)[0]
-        boxes = boxes[inds]
-        landms = landms[inds]
-        scores = scores[inds]
-
-        # keep top-K before NMS
-        order = scores.argsort()[::-1][:args.top_k]
-        boxes = boxes[order]
-        landms = landms[order]
-        scores = scores[order]
-
-        # do NMS
-        dets = np.hstack((boxes, scores[:, np.newaxis])).astype(np.float32, copy=False)
-        keep = py_cpu_nms(dets, args.nms_threshold)
-        # keep = nms(dets, args.nms_threshold,force_cpu=args.cpu)
-        dets = dets[keep, :]
-        landms = landms[keep]
-
-        # keep top-K faster NMS
-        dets = dets[:args.keep_top_k, :]
-        landms = landms[:args.keep_top_k, :]
-
-        output[image_path] = [dets, landms]
-
-        dets = np.concatenate((dets, landms), axis=1)
-
-
-
-        # show image
+        images = ((p, None) for p in img_paths)
+
+    def load(item):
+        image_path, img_raw = item
+        if img_raw is None:
+            img_raw = cv2.imread(image_path, cv2.IMREAD_COLOR)
+        return image_path, img_raw if args.save_image else None, preprocess(img_raw)
+
+    def output(dets_writer, image_path, img_raw, dets, landms):
+        dets_writer.write(image_path, dets, landms)
+
+        # show image, <img_raw> is not used by anything else
         if args.save_image:
-            for b in dets:
-                if b[4] < args.vis_thres:
-                    continue
-                text = "{:.4f}".format(b[4])
-                b = list(map(int, b))
-                cv2.rectangle(img_raw, (b[0], b[1]), (b[2], b[3]), (0, 0, 255), 2)
-                cx = b[0]
-                cy = b[1] + 12
-                cv2.putText(img_raw, text, (cx, cy),
-                            cv2.FONT_HERSHEY_DUPLEX, 0.5, (255, 255, 255))
-
-                # landms
-                cv2.circle(img_raw, (b[5], b[6]), 1, (0, 0, 255), 4)
-                cv2.circle(img_raw, (b[7], b[8]), 1, (0, 255, 255), 4)
-                cv2.circle(img_raw, (b[9], b[10]), 1, (255, 0, 255), 4)
-                cv2.circle(img_raw, (b[11], b[12]), 1, (0, 255, 0), 4)
-                cv2.circle(img_raw, (b[13], b[14]), 1, (255, 0, 0), 4)
-            # save image
-
-            name = "test.jpg"
-            cv2.imwrite(name, img_raw)
-
-
-    data = []
-    for ipath, (bboxes, kpss) in output.items():
-        line = [ipath, str(len(bboxes)), '$d']
-        for i in range(len(bboxes)):
-            conf = bboxes[i][-1]
-            bbox = bboxes[i][:-1]
-            bbox = list(map(int, bbox))
-            bbox = list(map(str, bbox))
-
-            landmarks = np.array(kpss[i]).astype(int).flatten()
-            landmarks = list(map(str, landmarks))
-            line.append(str(conf))
-            line.extend(bbox)
-            line.extend(landmarks)
-
-        data.append(' '.join(line))
-
-    with open(os.path.join(args.save_path, 'meta.txt'), 'w') as f:
-        f.write('\n'.join(data))
+            draw(img_raw, dets, landms, args)
 
+    loaded = prefetch(images, load, args.loaders, args.prefetch)
+
+    # results are written per image, so they survive a crash in the middle of the run
+    with DetsWriter(save_path) as dets_writer, AsyncWriter(output) as writer, \
+            tqdm(total=len(img_paths)) as progress:
+        # testing begin
+        for batch in bucket_batches(loaded, args.batch_size, args.bucket_step, args.max_buckets):
+            results = detect_preprocessed(net, cfg, device, [img for _, _, img in batch], args)
+            for (image_path, img_raw, _), (dets, landms) in zip(batch, results):
+                writer.write(dets_writer, image_path, img_raw, dets, landms)
+            progress.update(len(batch))
+
+    return len(img_paths)
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+
+    torch.set_grad_enabled(False)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    net, cfg, device = build_net(args)
+
+    if args.serve:
+        def handle(request):
+            if not os.path.exists(request['input']):
+                raise FileNotFoundError(f"Input ({request['input']}) is not visible inside the worker")
+            if not request.get('frames'):  # images are read from disk
+                check_visible(list_images(request['input']))
+            if request.get('threads'):
+                torch.set_num_threads(request['threads'])
+                if args.backend == 'onnx':  # onnxruntime doesn't use torch threads
+                    net.set_threads(request['threads'])
+            return {"images": run(net, cfg, device, request['input'], request['save_path'], args, request.get('frames'))}
+
+        serve(args.serve, handle)
+    else:
+        run(net, cfg, device, args.input, args.save_path, args, args.frames)
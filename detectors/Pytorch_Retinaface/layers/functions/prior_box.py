@@ -1,9 +1,35 @@
 import torch
-from itertools import product as product
+from functools import lru_cache
 import numpy as np
 from math import ceil
 
 
+PRIORS_CACHE_SIZE = 8  # priors of a 4000x3000 image take ~10Mb
+
+
+@lru_cache(maxsize=PRIORS_CACHE_SIZE)
+def _priors(min_sizes, steps, clip, image_size):
+    """ Anchors of all feature maps in (row, column, min_size) order. Cached per image size, don't modify the output. """
+    im_h, im_w = image_size
+    anchors = []
+    for step, sizes in zip(steps, min_sizes):
+        rows, cols = ceil(im_h / step), ceil(im_w / step)
+        cx = (np.arange(cols) + 0.5) * step / im_w
+        cy = (np.arange(rows) + 0.5) * step / im_h
+        s_kx = np.array(sizes, dtype=np.float64) / im_w
+        s_ky = np.array(sizes, dtype=np.float64) / im_h
+
+        shape = (rows, cols, len(sizes))
+        anchors.append(np.stack([np.broadcast_to(cx[None, :, None], shape), np.broadcast_to(cy[:, None, None], shape),
+                                 np.broadcast_to(s_kx, shape), np.broadcast_to(s_ky, shape)], axis=-1).reshape(-1, 4))
+
+    # back to torch land
+    output = torch.from_numpy(np.concatenate(anchors).astype(np.float32))
+    if clip:
+        output.clamp_(max=1, min=0)
+    return output
+
+
 class PriorBox(object):
     def __init__(self, cfg, image_size=None, phase='train'):
         super(PriorBox, self).__init__()
@@ -15,20 +41,4 @@ class PriorBox(object):
         self.name = "s"
 
     def forward(self):
-        anchors = []
-        for k, f in enumerate(self.feature_maps):
-            min_sizes = self.min_sizes[k]
-            for i, j in product(range(f[0]), range(f[1])):
-                for min_size in min_sizes:
-                    s_kx = min_size / self.image_size[1]
-                    s_ky = min_size / self.image_size[0]
-                    dense_cx = [x * self.steps[k] / self.image_size[1] for x in [j + 0.5]]
-                    dense_cy = [y * self.steps[k] / self.image_size[0] for y in [i + 0.5]]
-                    for cy, cx in product(dense_cy, dense_cx):
-                        anchors += [cx, cy, s_kx, s_ky]
-
-        # back to torch land
-        output = torch.Tensor(anchors).view(-1, 4)
-        if self.clip:
-            output.clamp_(max=1, min=0)
-        return output
+        return _priors(tuple(map(tuple, self.min_sizes)), tuple(self.steps), self.clip, tuple(self.image_size))
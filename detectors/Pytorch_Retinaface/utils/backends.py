@@ -0,0 +1,94 @@
+"""
+ File name   : backends.py
+ Description : Inference backends of RetinaFace. Every backend is called as net(img) with [n, 3, h, w] float tensor
+               and returns (loc, conf, landms) tensors, the same as eager RetinaFace in 'test' phase.
+
+ eager       - RetinaFace module as it is
+ torchscript - Conv-BN pairs fused into single convolutions, traced and frozen
+ onnx        - exported model (convert_to_onnx.py) run by onnxruntime
+"""
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+
+BACKENDS = ('eager', 'torchscript', 'onnx')
+
+
+def fuse_conv_bn(module: nn.Module) -> nn.Module:
+    """
+    Fold BatchNorm2d into preceding Conv2d in place: pairs in nn.Sequential (conv_bn, SSH, FPN, MobileNet)
+    and conv<N>/bn<N> attributes (torchvision ResNet). Folded BatchNorms are replaced by nn.Identity.
+    """
+    for child in module.children():
+        fuse_conv_bn(child)
+
+    if isinstance(module, nn.Sequential):
+        names = list(module._modules)
+        for conv_name, bn_name in zip(names, names[1:]):
+            conv, bn = module._modules[conv_name], module._modules[bn_name]
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                module._modules[conv_name] = fuse_conv_bn_eval(conv, bn)
+                module._modules[bn_name] = nn.Identity()
+
+    for name, conv in list(module._modules.items()):
+        bn_name = name.replace('conv', 'bn', 1)
+        bn = module._modules.get(bn_name)
+        if name.startswith('conv') and isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+            setattr(module, name, fuse_conv_bn_eval(conv, bn))
+            setattr(module, bn_name, nn.Identity())
+    return module
+
+
+def to_torchscript(net: nn.Module, device, example_size=(640, 640)) -> torch.jit.ScriptModule:
+    """ Fused and frozen trace of <net>. Sizes are traced as tensor ops, so any input size works. """
+    net = fuse_conv_bn(net.eval())
+    example = torch.zeros(1, 3, *example_size, device=device)
+    with torch.no_grad():
+        traced = torch.jit.trace(net, example, check_trace=False)
+    traced = torch.jit.freeze(traced)
+    if hasattr(torch.jit, 'optimize_for_inference'):  # torch >= 1.9
+        traced = torch.jit.optimize_for_inference(traced)
+    return traced
+
+
+class OnnxRetinaFace:
+    """ ONNX model exported with dynamic batch and image size (convert_to_onnx.py) run by onnxruntime on CPU. """
+    def __init__(self, model_path: str, threads: int = 0):
+        self.model_path = model_path
+        self.threads = threads
+        self.session = self._create_session()
+        self.input_name = self.session.get_inputs()[0].name
+
+    def _create_session(self):
+        import onnxruntime  # only this backend needs it
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if self.threads > 0:
+            options.intra_op_num_threads = self.threads
+        return onnxruntime.InferenceSession(self.model_path, options, providers=['CPUExecutionProvider'])
+
+    def set_threads(self, threads: int) -> None:
+        """ Intra-op pool size is fixed at session creation, so the session is recreated when it changes. """
+        if threads > 0 and threads != self.threads:
+            self.threads = threads
+            self.session = self._create_session()
+
+    def __call__(self, img: torch.Tensor):
+        outputs = self.session.run(None, {self.input_name: img.cpu().numpy()})
+        return tuple(torch.from_numpy(output).to(img.device) for output in outputs)
+
+    def eval(self):
+        return self
+
+
+def make_backend(backend: str, net: nn.Module, device, onnx_model: str = None, threads: int = 0):
+    if backend == 'eager':
+        return net
+    if backend == 'torchscript':
+        return to_torchscript(net, device)
+    if backend == 'onnx':
+        return OnnxRetinaFace(onnx_model, threads)
+    raise ValueError(f"Unknown backend ({backend}), use one of {BACKENDS}!!!")
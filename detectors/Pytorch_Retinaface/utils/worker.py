@@ -0,0 +1,72 @@
+"""
+ File name   : worker.py
+ Description : Long-lived detector worker which serves requests over a Unix socket.
+
+ Protocol: one JSON object per line in both directions. A request is a dict handled by the detector
+ (e.g. {"input": <path>, "save_path": <path>}), a response is {"status": "ok", ...} or
+ {"status": "error", "error": <message>}. {"cmd": "ping"} is answered without touching the model, also while
+ another connection is being served, so a busy worker is not taken for a dead one.
+"""
+
+import json
+import os
+import socket
+import threading
+import traceback
+from typing import Callable, Iterable
+
+
+def serve(socket_path: str, handle: Callable[[dict], dict]) -> None:
+    """ Load-once / serve-many loop. Every connection has its own thread, requests are processed one at a time. """
+    os.makedirs(os.path.dirname(os.path.abspath(socket_path)), exist_ok=True)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    os.chmod(socket_path, 0o777)  # socket is created by container root, but used by host user
+    server.listen(8)
+    print(f"Worker is listening on {socket_path}", flush=True)
+
+    lock = threading.Lock()  # the model serves one request at a time
+    try:
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=_serve_connection, args=(conn, handle, lock), daemon=True).start()
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def check_visible(img_paths: Iterable[str]) -> None:
+    """ Raise if some images can't be read inside the worker, e.g. they are outside of the mounted data root. """
+    missing = [path for path in img_paths if not os.path.isfile(path)]
+    if missing:
+        raise FileNotFoundError(f"{len(missing)} images are not visible inside the worker (is their folder under "
+                                f"the mounted data root?), e.g. ({missing[0]})")
+
+
+def _serve_connection(conn: socket.socket, handle: Callable[[dict], dict], lock: threading.Lock) -> None:
+    try:
+        with conn, conn.makefile('rwb') as stream:
+            for line in stream:
+                response = _dispatch(line, handle, lock)
+                stream.write((json.dumps(response) + '\n').encode())
+                stream.flush()
+    except (BrokenPipeError, ConnectionResetError):
+        pass  # client gave up waiting (e.g. ping timeout), the worker keeps serving others
+
+
+def _dispatch(line: bytes, handle: Callable[[dict], dict], lock: threading.Lock) -> dict:
+    try:
+        request = json.loads(line)
+        if request.get('cmd') == 'ping':
+            return {"status": "ok"}
+        with lock:
+            response = handle(request) or {}
+        response["status"] = "ok"
+        return response
+    except Exception as e:
+        traceback.print_exc()
+        return {"status": "error", "error": f"{type(e).__name__}: {e}"}
@@ -330,9 +330,15 @@ class SCRFDHead(AnchorHead):
             #    bbox_pred = bbox_pred.reshape(1, 4, -1).permute(0, 2, 1)
             #kps_pred = kps_pred.reshape(1, 10, -1).permute(0, 2, 1)
 
-            cls_score = cls_score.permute(2, 3, 0, 1).reshape(-1, self.cls_out_channels).sigmoid()
-            bbox_pred = bbox_pred.permute(2, 3, 0, 1).reshape(-1, 4)
-            kps_pred = kps_pred.permute(2,3,0,1).reshape(-1, 10)
+            if getattr(self, 'batched_onnx', False):
+                # [batch, anchors, channels], anchors of every image are in the same order as without batch axis
+                cls_score = cls_score.permute(0, 2, 3, 1).reshape(cls_score.shape[0], -1, self.cls_out_channels).sigmoid()
+                bbox_pred = bbox_pred.permute(0, 2, 3, 1).reshape(bbox_pred.shape[0], -1, 4)
+                kps_pred = kps_pred.permute(0, 2, 3, 1).reshape(kps_pred.shape[0], -1, 10)
+            else:
+                cls_score = cls_score.permute(2, 3, 0, 1).reshape(-1, self.cls_out_channels).sigmoid()
+                bbox_pred = bbox_pred.permute(2, 3, 0, 1).reshape(-1, 4)
+                kps_pred = kps_pred.permute(2,3,0,1).reshape(-1, 10)
         return cls_score, bbox_pred, kps_pred
 
     def forward_train(self,
@@ -0,0 +1,57 @@
+"""
+ File name   : batch_sweep.py
+ Description : Throughput of SCRFD.detect_batch for several batch sizes. The model should be exported with
+               scrfd2onnx.py --dynamic-batch, otherwise images of a batch are run one by one.
+"""
+
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from scrfd import SCRFD, list_images
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(); add = parser.add_argument
+    add('-m', '--model', type=str)
+    add('-i', '--input', type=str, default=None, help='Folder or .txt list of images, random images by default')
+    add('-n', '--num_images', type=int, default=64, help='Number of images per batch size')
+    add('--batch_sizes', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    add('-t', '--thresh', type=float, default=0.5)
+    add('--threads', type=int, default=0, help='Number of onnxruntime intra-op threads, 0 - onnxruntime default')
+    add('--io_binding', action='store_true', default=False)
+    return parser.parse_args()
+
+
+def _load_images(args):
+    if args.input:
+        img_paths = list_images(args.input)[:args.num_images]
+        return [img for img in map(cv2.imread, img_paths) if img is not None]
+    rng = np.random.default_rng(0)
+    return [rng.integers(0, 256, (720, 1280, 3), dtype=np.uint8) for _ in range(args.num_images)]
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+
+    detector = SCRFD(model_file=args.model, session_config=dict(io_binding=args.io_binding),
+                     threads=args.threads)
+    detector.prepare(-1, threads=args.threads)
+    if not detector.batched:
+        print("warning: model has no batch axis, images are run one by one")
+    imgs = _load_images(args)
+
+    results = []
+    for batch_size in args.batch_sizes:
+        detector.detect_batch(imgs[:batch_size], args.thresh, input_size=(640, 640))  # warmup
+        tic = time.time()
+        for start in range(0, len(imgs), batch_size):
+            detector.detect_batch(imgs[start: start + batch_size], args.thresh, input_size=(640, 640))
+        results.append((batch_size, len(imgs) / (time.time() - tic)))
+
+    print(f"\n{len(imgs)} images, {'batched' if detector.batched else 'not batched'} model")
+    print(f"{'batch':>6} {'img/s':>8} {'speedup':>8}")
+    for batch_size, throughput in results:
+        print(f"{batch_size:>6} {throughput:>8.2f} {throughput / results[0][1]:>7.2f}x")
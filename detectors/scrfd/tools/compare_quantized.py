@@ -0,0 +1,35 @@
+"""
+ File name   : compare_quantized.py
+ Description : Report speed and detections of the INT8 SCRFD model (scrfd2onnx.py --quantize) against fp32 one
+               on the same images.
+"""
+
+import argparse
+
+from scrfd import SCRFD, list_images
+from quantization import compare_models
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(); add = parser.add_argument
+    add('--fp32', type=str, help='fp32 model')
+    add('--int8', type=str, help='Quantized model')
+    add('-i', '--input', type=str, help='Folder or .txt list of images')
+    add('--limit', type=int, default=100, help='Number of images to compare on')
+    add('-t', '--thresh', type=float, default=0.2)
+    add('--threads', type=int, default=0, help='Number of onnxruntime intra-op threads, 0 - onnxruntime default')
+    add('--iou', type=float, default=0.5, help='IoU to match detections of the models')
+    return parser.parse_args()
+
+
+def _detector(model_path, args):
+    detector = SCRFD(model_file=model_path, threads=args.threads)
+    detector.prepare(-1, threads=args.threads)
+    return lambda img: detector.detect(img, args.thresh, input_size=(640, 640))[0]
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+
+    detectors = {'fp32': _detector(args.fp32, args), 'int8': _detector(args.int8, args)}
+    compare_models(detectors, list_images(args.input)[:args.limit], args.iou)
@@ -0,0 +1,82 @@
+"""
+ File name   : prefetch.py
+ Description : Pipelined inference loop: images are decoded and preprocessed by a pool of threads ahead of inference,
+               results are written by a background thread, so throughput approaches the slowest of the stages.
+
+    items --> load (N threads, at most <depth> images ahead) --> inference (caller) --> AsyncWriter (1 thread)
+
+ OpenCV and numpy release the GIL in decoding and resizing, so threads are enough and no image is pickled.
+"""
+
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, TypeVar
+
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+def prefetch(items: Iterable[T], load: Callable[[T], R], workers: int = 2, depth: int = 4) -> Iterator[R]:
+    """
+    Yield load(item) of every item in order. Up to <depth> items are loaded by <workers> threads while the caller
+    works on the previous ones; 0 workers - items are loaded one by one in the calling thread.
+    <items> are read in the calling thread, so every item must stay valid after the next one is read
+    (copy frames of the shared frame ring).
+    """
+    if workers <= 0:
+        yield from map(load, items)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(load, item))
+            if len(pending) >= max(depth, 1):
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class AsyncWriter:
+    """ Calls write(*args) in a background thread in order of calls. The first error is raised by a later call or close. """
+    def __init__(self, write: Callable, depth: int = 64):
+        self.write_fn = write
+        self.queue = queue.Queue(maxsize=depth)
+        self.error = None
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def _loop(self) -> None:
+        while True:
+            args = self.queue.get()
+            if args is None:
+                return
+            if self.error is None:  # after an error items are only drained, so writers don't block
+                try:
+                    self.write_fn(*args)
+                except Exception as e:
+                    self.error = e
+
+    def write(self, *args) -> None:
+        if self.error is not None:
+            raise self.error
+        self.queue.put(args)
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:  # keep the original error, results written so far are still flushed
+            self.queue.put(None)
+            self.thread.join()
@@ -0,0 +1,139 @@
+"""
+ File name   : quantization.py
+ Description : INT8 quantization of the exported SCRFD ONNX model with onnxruntime and comparison of detections
+               of the quantized model with fp32 ones.
+
+ dynamic - weights are quantized offline, activations on the fly; no calibration data is needed
+ static  - activation ranges are calibrated on sample images, model is saved in QDQ format
+"""
+
+import glob
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import cv2
+import numpy as np
+import onnx
+from onnxruntime.quantization import (CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic,
+                                      quantize_static)
+
+
+QUANT_MODES = ('dynamic', 'static')
+
+
+def list_sample_images(folder: str, count: int) -> List[str]:
+    img_paths = sorted(glob.glob(f"{folder}/**/*.jpg", recursive=True) + glob.glob(f"{folder}/**/*.png", recursive=True))
+    return img_paths[:count]
+
+
+def letterbox_blob(img: np.ndarray, size: int, mean: float = 127.5, std: float = 128.0) -> np.ndarray:
+    """ [1, 3, size, size] input of SCRFD: image resized by its long side and padded at the bottom-right, as SCRFD.detect does. """
+    scale = size / max(img.shape[:2])
+    resized = cv2.resize(img, (max(1, int(img.shape[1] * scale)), max(1, int(img.shape[0] * scale))))
+    det_img = np.zeros((size, size, 3), dtype=np.uint8)
+    det_img[:resized.shape[0], :resized.shape[1]] = resized
+    return cv2.dnn.blobFromImage(det_img, 1.0 / std, (size, size), (mean, mean, mean), swapRB=True)
+
+
+class ImageCalibrationReader(CalibrationDataReader):
+    """ Feeds sample images to onnxruntime calibration one by one. """
+    def __init__(self, img_paths: List[str], input_name: str, preprocess: Callable[[np.ndarray], np.ndarray]):
+        self.img_paths = img_paths
+        self.input_name = input_name
+        self.preprocess = preprocess
+        self.rewind()
+
+    def get_next(self) -> Optional[Dict[str, np.ndarray]]:
+        for path in self.iterator:
+            img = cv2.imread(path, cv2.IMREAD_COLOR)
+            if img is not None:
+                return {self.input_name: self.preprocess(img)}
+        return None
+
+    def rewind(self) -> None:
+        self.iterator = iter(self.img_paths)
+
+
+def quantize_model(model_path: str, output_path: str, mode: str, calibration: CalibrationDataReader = None,
+                   per_channel: bool = True) -> None:
+    if mode == 'dynamic':
+        # ConvInteger of onnxruntime CPU supports only uint8 weights
+        quantize_dynamic(model_path, output_path, weight_type=QuantType.QUInt8)
+    elif mode == 'static':
+        if calibration is None:
+            raise ValueError("Static quantization needs calibration images!!!")
+        opset = max(o.version for o in onnx.load(model_path).opset_import if o.domain in ('', 'ai.onnx'))
+        if per_channel and opset < 13:  # DequantizeLinear has no axis before opset 13
+            print(f"Model opset is {opset}, weights are quantized per tensor")
+            per_channel = False
+        quantize_static(model_path, output_path, calibration, quant_format=QuantFormat.QDQ, per_channel=per_channel,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+    else:
+        raise ValueError(f"Unknown quantization mode ({mode}), use one of {QUANT_MODES}!!!")
+    print(f"Quantized ({mode}) model is saved to {output_path}")
+
+
+def _iou(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    lt = np.maximum(a[:, None, :2], b[None, :, :2])
+    rb = np.minimum(a[:, None, 2:4], b[None, :, 2:4])
+    inter = np.prod(np.clip(rb - lt, 0, None), axis=2)
+    area_a = np.prod(a[:, 2:4] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:4] - b[:, :2], axis=1)
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-9)
+
+
+def match_detections(ref: np.ndarray, other: np.ndarray, thresh_iou: float = 0.5) -> List[Tuple[int, int, float]]:
+    """ Greedy one-to-one matching of [n, 5] detections, best scored <ref> first. Returns (ref, other, iou) triples. """
+    if not len(ref) or not len(other):
+        return []
+    ious = _iou(ref, other)
+    matches, taken = [], np.zeros(len(other), dtype=bool)
+    for i in np.argsort(-ref[:, 4], kind='stable'):
+        candidates = np.where(taken, -1, ious[i])
+        j = int(np.argmax(candidates))
+        if candidates[j] >= thresh_iou:
+            taken[j] = True
+            matches.append((int(i), j, float(ious[i, j])))
+    return matches
+
+
+def compare_models(detectors: Dict[str, Callable[[np.ndarray], np.ndarray]], img_paths: Iterable[str],
+                   thresh_iou: float = 0.5) -> None:
+    """
+    Run every detector (image -> [n, 5+] detections) on the same images and print time per image and
+    agreement of detections with the first (reference) detector.
+    """
+    names = list(detectors)
+    times = {name: 0. for name in names}
+    stats = {name: dict(dets=0, matched=0, iou=0., score=0.) for name in names}
+    count = 0
+    for path in img_paths:
+        img = cv2.imread(path, cv2.IMREAD_COLOR)
+        if img is None:
+            continue
+        count += 1
+        outputs = dict()
+        for name in names:
+            tic = time.time()
+            outputs[name] = np.asarray(detectors[name](img))
+            times[name] += time.time() - tic
+
+        ref = outputs[names[0]]
+        for name in names:
+            matches = match_detections(ref, outputs[name], thresh_iou)
+            stats[name]['dets'] += len(outputs[name])
+            stats[name]['matched'] += len(matches)
+            stats[name]['iou'] += sum(iou for _, _, iou in matches)
+            stats[name]['score'] += sum(abs(float(ref[i, 4] - outputs[name][j, 4])) for i, j, _ in matches)
+
+    if not count:
+        raise ValueError("No images to compare on!!!")
+    ref_dets = max(stats[names[0]]['dets'], 1)
+    print(f"\n{count} images, detections matched with <{names[0]}> at IoU >= {thresh_iou}")
+    print(f"{'model':<10} {'ms/img':>8} {'speedup':>8} {'dets':>7} {'recall':>7} {'extra':>6} {'mean IoU':>9} {'|d score|':>10}")
+    for name in names:
+        s = stats[name]
+        matched = max(s['matched'], 1)
+        print(f"{name:<10} {times[name] / count * 1000:>8.1f} {times[names[0]] / times[name]:>7.2f}x {s['dets']:>7} "
+              f"{s['matched'] / ref_dets:>7.3f} {s['dets'] - s['matched']:>6} {s['iou'] / matched:>9.4f} "
+              f"{s['score'] / matched:>10.4f}")
@@ -12,6 +12,13 @@ import os
 import os.path as osp
 import cv2
 import json
+from collections import OrderedDict
+from itertools import islice
+
+from worker import check_visible, serve
+from frames import read_frames
+from dets import DetsWriter
+from prefetch import AsyncWriter, prefetch
 
 def softmax(z):
     assert len(z.shape) == 2
@@ -57,28 +64,39 @@ def distance2kps(points, distance, max_shape=None):
     Returns:
         Tensor: Decoded bboxes.
     """
-    preds = []
-    for i in range(0, distance.shape[1], 2):
-        px = points[:, i%2] + distance[:, i]
-        py = points[:, i%2+1] + distance[:, i+1]
-        if max_shape is not None:
-            px = px.clamp(min=0, max=max_shape[1])
-            py = py.clamp(min=0, max=max_shape[0])
-        preds.append(px)
-        preds.append(py)
-    return np.stack(preds, axis=-1)
+    # every (x, y) pair of distance is an offset from the point
+    preds = points[:, np.newaxis, :] + distance.reshape(distance.shape[0], distance.shape[1] // 2, 2)
+    if max_shape is not None:
+        preds[..., 0] = preds[..., 0].clip(min=0, max=max_shape[1])
+        preds[..., 1] = preds[..., 1].clip(min=0, max=max_shape[0])
+    return preds.reshape(distance.shape)
+
+CENTER_CACHE_SIZE = 100  # anchor centers of this many (height, width, stride) are kept
+BINDING_CACHE_SIZE = 8  # IO bindings with preallocated outputs of this many input shapes are kept
+GRAPH_OPT_LEVELS = {'disable': 'ORT_DISABLE_ALL', 'basic': 'ORT_ENABLE_BASIC',
+                    'extended': 'ORT_ENABLE_EXTENDED', 'all': 'ORT_ENABLE_ALL'}
+
 
 class SCRFD:
-    def __init__(self, model_file=None, session=None):
-        import onnxruntime
+    def __init__(self, model_file=None, session=None, session_config=None, threads=0):
+        """
+        <threads> - intra-op threads of the session, 0 - onnxruntime default. Pass them here rather than to prepare,
+        otherwise the session is created twice.
+        <session_config> tunes onnxruntime session: inter_threads, graph_opt (one of GRAPH_OPT_LEVELS),
+        execution_mode ('sequential' or 'parallel'), mem_arena, optimized_model (path of optimized model cache)
+        and io_binding (run with preallocated outputs reused across images).
+        """
         self.model_file = model_file
         self.session = session
+        self.session_config = dict(session_config or {})
         self.taskname = 'detection'
+        self.threads = threads
         if self.session is None:
             assert self.model_file is not None
             assert osp.exists(self.model_file)
-            self.session = onnxruntime.InferenceSession(self.model_file, None)
-        self.center_cache = {}
+            self.session = self._create_session()
+        self.bindings = OrderedDict()
+        self.center_cache = OrderedDict()
         self.nms_thresh = 0.4
         self._init_vars()
 
@@ -96,6 +114,8 @@ class SCRFD:
             output_names.append(o.name)
         self.input_name = input_name
         self.output_names = output_names
+        # exported with dynamic batch axis (scrfd2onnx.py --dynamic-batch): [batch, anchors, channels] outputs
+        self.batched = len(outputs[0].shape) == 3
         self.use_kps = False
         self._num_anchors = 1
         if len(outputs)==6:
@@ -117,7 +137,72 @@ class SCRFD:
             self._num_anchors = 1
             self.use_kps = True
 
+    def _create_session(self):
+        import onnxruntime
+        config = self.session_config
+        options = onnxruntime.SessionOptions()
+        if self.threads:
+            options.intra_op_num_threads = self.threads
+        if config.get('inter_threads'):
+            options.inter_op_num_threads = config['inter_threads']
+        if config.get('execution_mode') == 'parallel':
+            options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+        options.graph_optimization_level = getattr(onnxruntime.GraphOptimizationLevel,
+                                                   GRAPH_OPT_LEVELS[config.get('graph_opt', 'all')])
+        options.enable_cpu_mem_arena = config.get('mem_arena', True)
+
+        optimized_model = config.get('optimized_model')
+        if not optimized_model:
+            return onnxruntime.InferenceSession(self.model_file, options)
+
+        # options the cached graph was optimized with are stored next to it
+        stamp_path = optimized_model + '.json'
+        stamp = dict(model=osp.abspath(self.model_file), graph_opt=config.get('graph_opt', 'all'),
+                     execution_mode=config.get('execution_mode', 'sequential'))
+        if osp.exists(optimized_model) and osp.exists(stamp_path) and \
+                osp.getmtime(optimized_model) >= osp.getmtime(self.model_file):
+            with open(stamp_path) as f:
+                if json.load(f) == stamp:  # the graph is already optimized, session starts faster
+                    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+                    return onnxruntime.InferenceSession(optimized_model, options)
+
+        options.optimized_model_filepath = optimized_model
+        session = onnxruntime.InferenceSession(self.model_file, options)
+        with open(stamp_path, 'w') as f:
+            json.dump(stamp, f)
+        return session
+
+    def _run(self, blob):
+        """ session.run, with <io_binding> outputs are written to buffers reused for inputs of the same shape. """
+        if not self.session_config.get('io_binding'):
+            return self.session.run(self.output_names, {self.input_name : blob})
+
+        key = blob.shape
+        if key not in self.bindings:
+            # shapes of outputs are known after the first run
+            net_outs = self.session.run(self.output_names, {self.input_name : blob})
+            binding = self.session.io_binding()
+            buffers = [np.empty_like(out) for out in net_outs]
+            for name, buffer in zip(self.output_names, buffers):
+                binding.bind_output(name, 'cpu', 0, buffer.dtype, list(buffer.shape), buffer.ctypes.data)
+            self.bindings[key] = (binding, buffers)
+            if len(self.bindings) > BINDING_CACHE_SIZE:
+                self.bindings.popitem(last=False)
+            return net_outs
+
+        self.bindings.move_to_end(key)
+        binding, buffers = self.bindings[key]
+        binding.bind_cpu_input(self.input_name, blob)
+        self.session.run_with_iobinding(binding)
+        return buffers
+
     def prepare(self, ctx_id, **kwargs):
+        threads = kwargs.get('threads', 0)
+        if threads and threads != self.threads and self.model_file is not None:
+            # intra-op pool size is fixed at session creation
+            self.threads = threads
+            self.session = self._create_session()
+            self.bindings.clear()
         if ctx_id<0:
             self.session.set_providers(['CPUExecutionProvider'])
         nms_thresh = kwargs.get('nms_thresh', None)
@@ -131,70 +216,87 @@ class SCRFD:
                 self.input_size = input_size
 
     def forward(self, img, thresh):
+        input_size = tuple(img.shape[0:2][::-1])
+        blob = cv2.dnn.blobFromImage(img, 1.0/128, input_size, (127.5, 127.5, 127.5), swapRB=True)
+        net_outs = self._run(blob)  # buffers may be reused by the next run, only copies of them are returned
+        if self.batched:
+            net_outs = [out[0] for out in net_outs]
+        return self._decode(net_outs, blob.shape[2], blob.shape[3], thresh)
+
+    def forward_batch(self, imgs, thresh):
+        """ Images of the same size in one run, model must have batch axis. Returns forward output of every image. """
+        input_size = tuple(imgs[0].shape[0:2][::-1])
+        blob = cv2.dnn.blobFromImages(imgs, 1.0/128, input_size, (127.5, 127.5, 127.5), swapRB=True)
+        net_outs = self._run(blob)
+        return [self._decode([out[i] for out in net_outs], blob.shape[2], blob.shape[3], thresh) for i in range(len(imgs))]
+
+    def _decode(self, net_outs, input_height, input_width, thresh):
         scores_list = []
         bboxes_list = []
         kpss_list = []
-        input_size = tuple(img.shape[0:2][::-1])
-        blob = cv2.dnn.blobFromImage(img, 1.0/128, input_size, (127.5, 127.5, 127.5), swapRB=True)
-        net_outs = self.session.run(self.output_names, {self.input_name : blob})
-
-        input_height = blob.shape[2]
-        input_width = blob.shape[3]
         fmc = self.fmc
         for idx, stride in enumerate(self._feat_stride_fpn):
             scores = net_outs[idx]
-            bbox_preds = net_outs[idx+fmc]
-            bbox_preds = bbox_preds * stride
-            if self.use_kps:
-                kps_preds = net_outs[idx+fmc*2] * stride
             height = input_height // stride
             width = input_width // stride
-            K = height * width
-            key = (height, width, stride)
-            if key in self.center_cache:
-                anchor_centers = self.center_cache[key]
-            else:
-                #solution-1, c style:
-                #anchor_centers = np.zeros( (height, width, 2), dtype=np.float32 )
-                #for i in range(height):
-                #    anchor_centers[i, :, 1] = i
-                #for i in range(width):
-                #    anchor_centers[:, i, 0] = i
-
-                #solution-2:
-                #ax = np.arange(width, dtype=np.float32)
-                #ay = np.arange(height, dtype=np.float32)
-                #xv, yv = np.meshgrid(np.arange(width), np.arange(height))
-                #anchor_centers = np.stack([xv, yv], axis=-1).astype(np.float32)
-
-                #solution-3:
-                anchor_centers = np.stack(np.mgrid[:height, :width][::-1], axis=-1).astype(np.float32)
-                #print(anchor_centers.shape)
-
-                anchor_centers = (anchor_centers * stride).reshape( (-1, 2) )
-                if self._num_anchors>1:
-                    anchor_centers = np.stack([anchor_centers]*self._num_anchors, axis=1).reshape( (-1,2) )
-                if len(self.center_cache)<100:
-                    self.center_cache[key] = anchor_centers
+            anchor_centers = self._anchor_centers(height, width, stride)
 
+            # only anchors above threshold are decoded
             pos_inds = np.where(scores>=thresh)[0]
-            bboxes = distance2bbox(anchor_centers, bbox_preds)
+            pos_centers = anchor_centers[pos_inds]
             pos_scores = scores[pos_inds]
-            pos_bboxes = bboxes[pos_inds]
+            pos_bboxes = distance2bbox(pos_centers, net_outs[idx+fmc][pos_inds] * stride)
             scores_list.append(pos_scores)
             bboxes_list.append(pos_bboxes)
             if self.use_kps:
-                kpss = distance2kps(anchor_centers, kps_preds)
-                #kpss = kps_preds
-                kpss = kpss.reshape( (kpss.shape[0], -1, 2) )
-                pos_kpss = kpss[pos_inds]
+                pos_kpss = distance2kps(pos_centers, net_outs[idx+fmc*2][pos_inds] * stride)
+                pos_kpss = pos_kpss.reshape( (pos_kpss.shape[0], pos_kpss.shape[1] // 2, 2) )
                 kpss_list.append(pos_kpss)
         return scores_list, bboxes_list, kpss_list
 
+    def _anchor_centers(self, height, width, stride):
+        """ (x, y) of every anchor of the feature map, least recently used ones are evicted from the cache. """
+        key = (height, width, stride)
+        if key in self.center_cache:
+            self.center_cache.move_to_end(key)
+            return self.center_cache[key]
+
+        anchor_centers = np.stack(np.mgrid[:height, :width][::-1], axis=-1).astype(np.float32)
+        anchor_centers = (anchor_centers * stride).reshape( (-1, 2) )
+        if self._num_anchors>1:
+            anchor_centers = np.stack([anchor_centers]*self._num_anchors, axis=1).reshape( (-1,2) )
+        self.center_cache[key] = anchor_centers
+        if len(self.center_cache) > CENTER_CACHE_SIZE:
+            self.center_cache.popitem(last=False)
+        return anchor_centers
+
     def detect(self, img, thresh=0.5, input_size = None, max_num=0, metric='default'):
         assert input_size is not None or self.input_size is not None
         input_size = self.input_size if input_size is None else input_size
-            
+
+        det_img, det_scale = self.letterbox(img, input_size)
+        scores_list, bboxes_list, kpss_list = self.forward(det_img, thresh)
+        return self._postprocess(scores_list, bboxes_list, kpss_list, det_scale, img.shape, max_num, metric)
+
+    def detect_batch(self, imgs, thresh=0.5, input_size = None, max_num=0, metric='default'):
+        """ detect of every image. Letterboxed images have the same size, so batched models run them at once. """
+        assert input_size is not None or self.input_size is not None
+        input_size = self.input_size if input_size is None else input_size
+
+        det_imgs, det_scales = zip(*[self.letterbox(img, input_size) for img in imgs])
+        return self.detect_letterboxed(det_imgs, det_scales, [img.shape for img in imgs], thresh, max_num, metric)
+
+    def detect_letterboxed(self, det_imgs, det_scales, img_shapes, thresh=0.5, max_num=0, metric='default'):
+        """ detect_batch of images already letterboxed to the input size (e.g. by loader threads). """
+        if self.batched:
+            outputs = self.forward_batch(det_imgs, thresh)
+        else:
+            outputs = [self.forward(det_img, thresh) for det_img in det_imgs]
+        return [self._postprocess(*output, det_scale, img_shape, max_num, metric)
+                for output, det_scale, img_shape in zip(outputs, det_scales, img_shapes)]
+
+    def letterbox(self, img, input_size):
+        """ Image resized to fit <input_size> and padded at the bottom-right, and its scale. """
         im_ratio = float(img.shape[0]) / img.shape[1]
         model_ratio = float(input_size[1]) / input_size[0]
         if im_ratio>model_ratio:
@@ -207,9 +309,9 @@ class SCRFD:
         resized_img = cv2.resize(img, (new_width, new_height))
         det_img = np.zeros( (input_size[1], input_size[0], 3), dtype=np.uint8 )
         det_img[:new_height, :new_width, :] = resized_img
+        return det_img, det_scale
 
-        scores_list, bboxes_list, kpss_list = self.forward(det_img, thresh)
-
+    def _postprocess(self, scores_list, bboxes_list, kpss_list, det_scale, img_shape, max_num=0, metric='default'):
         scores = np.vstack(scores_list)
         scores_ravel = scores.ravel()
         order = scores_ravel.argsort()[::-1]
@@ -228,7 +330,7 @@ class SCRFD:
         if max_num > 0 and det.shape[0] > max_num:
             area = (det[:, 2] - det[:, 0]) * (det[:, 3] -
                                                     det[:, 1])
-            img_center = img.shape[0] // 2, img.shape[1] // 2
+            img_center = img_shape[0] // 2, img_shape[1] // 2
             offsets = np.vstack([
                 (det[:, 0] + det[:, 2]) / 2 - img_center[1],
                 (det[:, 1] + det[:, 3]) / 2 - img_center[0]
@@ -297,73 +399,115 @@ def _parse_args():
     add('-i', '--input', type=str)
     add('-t', '--thresh', type=float, default=0.5)
     add('-s', '--save_path', type=str, default='./')
+    add('--threads', type=int, default=0, help='Number of onnxruntime intra-op threads, 0 - onnxruntime default')
+    add('--inter_threads', type=int, default=0, help='Number of onnxruntime inter-op threads (parallel execution mode)')
+    add('--graph_opt', type=str, default='all', choices=list(GRAPH_OPT_LEVELS), help='onnxruntime graph optimization level')
+    add('--execution_mode', type=str, default='sequential', choices=['sequential', 'parallel'])
+    add('--no_mem_arena', action='store_true', default=False, help='Disable onnxruntime CPU memory arena')
+    add('--optimized_model', type=str, default=None,
+        help='Save optimized model to this path on the first start and load it on next ones')
+    add('--io_binding', action='store_true', default=False,
+        help='Bind preallocated output buffers which are reused across images')
+    add('--batch_size', type=int, default=1,
+        help='Number of images per run, models exported with --dynamic-batch run them at once')
+    add('--loaders', type=int, default=2,
+        help='Number of threads decoding and letterboxing images ahead of inference, 0 - in the main thread')
+    add('--prefetch', type=int, default=8, help='Number of images loaded ahead of inference')
+    add('--frames', type=str, default=None, help='Read decoded images of <input> from the shared frame ring in the given folder')
+    add('--serve', type=str, default=None, help='Run as long-lived worker listening on the given Unix socket path')
     add('--draw', action='store_true', default=False)
     return parser.parse_args()
 
 
-if __name__ == '__main__':
-
-    args = _parse_args()
-
-    detector = SCRFD(model_file=args.model)
-    detector.prepare(-1)
-
-    if args.input.split('.')[-1] in ('jpg', 'png'):
-        img_paths = [args.input]
+def list_images(input_path):
+    if input_path.split('.')[-1] in ('jpg', 'png'):
+        img_paths = [input_path]
+    elif input_path.endswith('.txt'):
+        with open(input_path) as f:
+            img_paths = [line.strip() for line in f if line.strip()]
     else:
-        img_paths = glob.glob(f"{args.input}/**/*.jpg", recursive=True)
-        img_paths.extend(  glob.glob(f"{args.input}/**/*.png", recursive=True) )
-
-    os.makedirs(args.save_path, exist_ok=True)
-
-    output = dict()
+        img_paths = glob.glob(f"{input_path}/**/*.jpg", recursive=True)
+        img_paths.extend(  glob.glob(f"{input_path}/**/*.png", recursive=True) )
+    return img_paths
 
-    for img_path in tqdm(img_paths):
-        img = cv2.imread(img_path)
-        bboxes, kpss = detector.detect(img, args.thresh, input_size = (640, 640))
 
 
-        output[img_path] = [bboxes.tolist(), kpss.tolist()]
-        if args.draw:
-            for i in range(bboxes.shape[0]):
-                bbox = bboxes[i]
-                x1,y1,x2,y2,score = bbox.astype(np.int)
-                cv2.rectangle(img, (x1,y1)  , (x2,y2) , (255,0,0) , 2)
-                if kpss is not None:
-                    kps = kpss[i]
-                    for kp in kps:
-                        kp = kp.astype(np.int)
-                        cv2.circle(img, tuple(kp) , 1, (0,0,255) , 2)
-
+def draw(img, img_path, bboxes, kpss, save_path):
+    img = img.copy()
+    for i in range(bboxes.shape[0]):
+        bbox = bboxes[i]
+        x1,y1,x2,y2,score = bbox.astype(np.int)
+        cv2.rectangle(img, (x1,y1)  , (x2,y2) , (255,0,0) , 2)
+        if kpss is not None:
+            kps = kpss[i]
+            for kp in kps:
+                kp = kp.astype(np.int)
+                cv2.circle(img, tuple(kp) , 1, (0,0,255) , 2)
 
-            filename = img_path.split('/')[-1]
-            cv2.imwrite(os.path.join(args.save_path, filename), img)
+    filename = img_path.split('/')[-1]
+    cv2.imwrite(os.path.join(save_path, filename), img)
 
-    data = []
-    for ipath, (bboxes, kpss) in output.items():
-        line = [ipath, str(len(bboxes)), '$d']
-        for i in range(len(bboxes)):
-            conf = bboxes[i][-1]
-            bbox = bboxes[i][:-1]
-            bbox = list(map(int, bbox))
-            bbox = list(map(str, bbox))
 
-            landmarks = np.array(kpss[i]).astype(int).flatten()
-            landmarks = list(map(str, landmarks))
-            line.append(str(conf))
-            line.extend(bbox)
-            line.extend(landmarks)
+def run(detector, input_path, save_path, args, frames=None):
+    img_paths = list_images(input_path)
+    os.makedirs(save_path, exist_ok=True)
 
-        data.append(' '.join(line))
+    input_size = (640, 640)
 
-    with open(os.path.join(args.save_path, 'meta.txt'), 'w') as f:
-        f.write('\n'.join(data))
+    if frames:  # images are already decoded by run.py
+        # frames of the ring are valid only until the next one is read, loaders work on copies
+        images = ((p, img.copy()) for p, img in read_frames(frames, img_paths, save_path))
+    else:
+        images = ((p, None) for p in img_paths)
 
+    def load(item):
+        img_path, img = item
+        if img is None:
+            img = cv2.imread(img_path)
+        det_img, det_scale = detector.letterbox(img, input_size)
+        return img_path, img if args.draw else None, img.shape, det_img, det_scale
 
+    loaded = prefetch(images, load, args.loaders, args.prefetch)
+    batches = iter(lambda: list(islice(loaded, args.batch_size)), [])
 
+    def output(dets_writer, img_path, img, bboxes, kpss):
+        dets_writer.write(img_path, bboxes, kpss)
+        if args.draw:
+            draw(img, img_path, bboxes, kpss, save_path)
 
+    # results are written per image, so they survive a crash in the middle of the run
+    with DetsWriter(save_path) as dets_writer, AsyncWriter(output) as writer, \
+            tqdm(total=len(img_paths)) as progress:
+        for batch in batches:
+            paths, imgs, img_shapes, det_imgs, det_scales = zip(*batch)
+            results = detector.detect_letterboxed(det_imgs, det_scales, img_shapes, args.thresh)
+            for img_path, img, (bboxes, kpss) in zip(paths, imgs, results):
+                writer.write(dets_writer, img_path, img, bboxes, kpss)
+            progress.update(len(batch))
 
+    return len(img_paths)
 
 
+if __name__ == '__main__':
 
+    args = _parse_args()
 
+    session_config = dict(inter_threads=args.inter_threads, graph_opt=args.graph_opt, execution_mode=args.execution_mode,
+                          mem_arena=not args.no_mem_arena, optimized_model=args.optimized_model,
+                          io_binding=args.io_binding)
+    detector = SCRFD(model_file=args.model, session_config=session_config, threads=args.threads)
+    detector.prepare(-1, threads=args.threads)
+
+    if args.serve:
+        def handle(request):
+            if not os.path.exists(request['input']):
+                raise FileNotFoundError(f"Input ({request['input']}) is not visible inside the worker")
+            if not request.get('frames'):  # images are read from disk
+                check_visible(list_images(request['input']))
+            if request.get('threads'):
+                detector.prepare(-1, threads=request['threads'])
+            return {"images": run(detector, request['input'], request['save_path'], args, request.get('frames'))}
+
+        serve(args.serve, handle)
+    else:
+        run(detector, args.input, args.save_path, args, args.frames)
@@ -22,6 +22,7 @@ def pytorch2onnx(config_path,
                  verify=False,
                  simplify = True,
                  dynamic = True,
+                 dynamic_batch = False,
                  normalize_cfg=None,
                  dataset='coco',
                  test_img=None):
@@ -47,7 +48,13 @@ def pytorch2onnx(config_path,
     if tmp_ckpt_file is not None:
         os.remove(tmp_ckpt_file)
 
-    if simplify or dynamic:
+    dynamic_axes = None
+    if dynamic_batch:
+        # outputs get [batch, anchors, channels] shape instead of [anchors, channels]
+        model.bbox_head.batched_onnx = True
+        dynamic_axes = {'input.1': {0: 'batch'}}
+
+    if simplify or dynamic or dynamic_batch:
         ori_output_file = output_file.split('.')[0]+"_ori.onnx"
     else:
         ori_output_file = output_file
@@ -57,16 +64,20 @@ def pytorch2onnx(config_path,
         ori_output_file,
         keep_initializers_as_inputs=False,
         verbose=False,
-        opset_version=opset_version)
-    if simplify or dynamic:
+        opset_version=opset_version,
+        input_names=['input.1'],
+        dynamic_axes=dynamic_axes)
+    if simplify or dynamic or dynamic_batch:
         model = onnx.load(ori_output_file)
         if dynamic:
             model.graph.input[0].type.tensor_type.shape.dim[2].dim_param = '?'
             model.graph.input[0].type.tensor_type.shape.dim[3].dim_param = '?'
+        if dynamic_batch:
+            model.graph.input[0].type.tensor_type.shape.dim[0].dim_param = 'batch'
         if simplify:
             from onnxsim import simplify
             #print(model.graph.input[0])
-            if dynamic:
+            if dynamic or dynamic_batch:
                 input_shapes = {model.graph.input[0].name : list(input_shape)}
                 model, check = simplify(model, input_shapes=input_shapes, dynamic_input_shape=True)
             else:
@@ -116,6 +127,28 @@ def parse_args():
         nargs='+',
         default=[128.0, 128.0, 128.0],
         help='variance value used for preprocess input data')
+    parser.add_argument(
+        '--dynamic-batch',
+        action='store_true',
+        help='export with dynamic batch axis, outputs get [batch, anchors, '
+        'channels] shape (SCRFD.detect_batch runs such models in batches)')
+    parser.add_argument(
+        '--quantize',
+        type=str,
+        default=None,
+        choices=['dynamic', 'static'],
+        help='also save INT8 model (<output-file>_int8.onnx): dynamic or '
+        'static calibrated on <calib-images>')
+    parser.add_argument(
+        '--calib-images',
+        type=str,
+        default=None,
+        help='folder with sample images for static calibration')
+    parser.add_argument(
+        '--calib-count',
+        type=int,
+        default=100,
+        help='number of images used for calibration')
     args = parser.parse_args()
     return args
 
@@ -173,6 +206,29 @@ if __name__ == '__main__':
         verify=args.verify,
         simplify = simplify,
         dynamic = dynamic,
+        dynamic_batch=args.dynamic_batch,
         normalize_cfg=normalize_cfg,
         dataset=args.dataset,
         test_img=args.test_img)
+
+    if args.quantize:
+        from quantization import (ImageCalibrationReader, letterbox_blob,
+                                  list_sample_images, quantize_model)
+
+        calibration = None
+        if args.quantize == 'static':
+            img_paths = list_sample_images(
+                args.calib_images,
+                args.calib_count) if args.calib_images else []
+            if not img_paths:
+                raise ValueError('set --calib-images folder with images '
+                                 'for static quantization')
+            input_name = onnx.load(args.output_file).graph.input[0].name
+            size = input_shape[2]
+            calibration = ImageCalibrationReader(
+                img_paths, input_name,
+                lambda img: letterbox_blob(img, size, args.mean[0],
+                                           args.std[0]))
+        quantize_model(args.output_file,
+                       args.output_file[:-len('.onnx')] + '_int8.onnx',
+                       args.quantize, calibration)
@@ -0,0 +1,48 @@
+"""
+ File name   : dets.py
+ Description : Binary detections output read by run.py (utils/io.py) instead of parsing text meta.txt.
+
+ Output folder layout:
+    dets.bin - flat float32 rows "x1 y1 x2 y2 score l1..l10", landmarks are -1 when detector doesn't provide them
+    dets.tsv - "path start count" line per image, appended after its rows are written
+"""
+
+import os
+from typing import Optional
+
+import numpy as np
+
+
+DET_SIZE = 1 + 4 + 10
+
+
+class DetsWriter:
+    def __init__(self, save_path: str):
+        self.bin = open(os.path.join(save_path, 'dets.bin'), 'wb')
+        self.index = open(os.path.join(save_path, 'dets.tsv'), 'w')
+        self.rows = 0
+
+    def write(self, ipath: str, bboxes: np.ndarray, kpss: Optional[np.ndarray] = None) -> None:
+        """ <bboxes> - [n, 5] boxes with scores, <kpss> - [n, 5, 2] or [n, 10] landmarks. """
+        bboxes = np.asarray(bboxes, dtype=np.float32).reshape(-1, 5)
+        rows = np.full((len(bboxes), DET_SIZE), -1, dtype=np.float32)
+        rows[:, :5] = bboxes
+        if kpss is not None and len(bboxes):
+            rows[:, 5:] = np.asarray(kpss, dtype=np.float32).reshape(len(bboxes), 10)
+
+        self.bin.write(rows.tobytes())
+        self.bin.flush()
+        # the line is the commit point: rows of an image are complete when its line is complete
+        self.index.write(f"{ipath}\t{self.rows}\t{len(rows)}\n")
+        self.index.flush()
+        self.rows += len(rows)
+
+    def close(self) -> None:
+        self.bin.close()
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
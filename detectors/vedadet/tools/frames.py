@@ -0,0 +1,47 @@
+"""
+ File name   : frames.py
+ Description : Reader of the shared frame ring written by run.py (utils/frames.py), so images are decoded once for all detectors.
+
+ Ring directory layout:
+    frames.bin - memory-mapped buffer with decoded uint8 BGR frames
+    index.tsv  - "seq path offset height width" line per frame, appended after the frame is written; "END" closes the ring
+ The reader reports frames it released in <save_path>/frames.pos, so the writer can reuse their space.
+"""
+
+import os
+import time
+from typing import Iterable, Iterator, Tuple
+
+import numpy as np
+
+
+POLL_INTERVAL = 0.01  # seconds
+
+
+def read_frames(ring_dir: str, img_paths: Iterable[str], save_path: str) -> Iterator[Tuple[str, np.ndarray]]:
+    """ Yield (path, frame) for frames of <img_paths> in ring order. Frames are read-only views valid until next step. """
+    wanted = set(img_paths)
+    buffer = np.memmap(os.path.join(ring_dir, 'frames.bin'), dtype=np.uint8, mode='r')
+    pos_path = os.path.join(save_path, 'frames.pos')
+
+    with open(os.path.join(ring_dir, 'index.tsv'), 'rb') as index, open(pos_path, 'w') as pos:
+        rest = b''
+        while True:
+            chunk = index.readline()
+            if not chunk.endswith(b'\n'):  # writer didn't finish the line yet
+                rest += chunk
+                time.sleep(POLL_INTERVAL)
+                continue
+            line, rest = (rest + chunk).decode().rstrip('\n'), b''
+            if line == 'END':
+                break
+
+            seq, path, offset, height, width = line.split('\t')
+            if path in wanted:
+                offset, height, width = int(offset), int(height), int(width)
+                yield path, buffer[offset: offset + height * width * 3].reshape(height, width, 3)
+
+            # frame is released, its space can be reused by writer
+            pos.seek(0)
+            pos.write(f"{int(seq):016d}")
+            pos.flush()
@@ -12,6 +12,10 @@ from vedacore.misc import Config, color_val, load_weights
 from vedacore.parallel import collate, scatter
 from vedadet.datasets.pipelines import Compose
 from vedadet.engines import build_engine
+from tools.worker import check_visible, serve
+from tools.frames import read_frames
+from tools.dets import DetsWriter
+from tools.prefetch import AsyncWriter, prefetch
 
 
 
@@ -69,75 +73,111 @@ def _parse_args():
     add('-i', '--input', type=str)
     add('-t', '--thresh', type=float, default=0.5)
     add('-s', '--save_path', type=str, default='./')
+    add('--threads', type=int, default=0, help='Number of CPU threads, 0 - torch default')
+    add('--loaders', type=int, default=2,
+        help='Number of threads decoding and preprocessing images ahead of inference, 0 - in the main thread')
+    add('--prefetch', type=int, default=4, help='Number of images loaded ahead of inference')
+    add('--frames', type=str, default=None, help='Read decoded images of <input> from the shared frame ring in the given folder')
+    add('--serve', type=str, default=None, help='Run as long-lived worker listening on the given Unix socket path')
     add('--draw', action='store_true', default=False)
 
     args = parser.parse_args()
     return args
 
-def main():
 
-    args = _parse_args()
-    cfg = Config.fromfile(args.config)
-    cfg.infer_engine['test_cfg']['score_thr'] = args.thresh
+def list_images(input_path):
+    if input_path.split('.')[-1] in ('jpg', 'png'):
+        img_paths = [input_path]
+    elif input_path.endswith('.txt'):
+        with open(input_path) as f:
+            img_paths = [line.strip() for line in f if line.strip()]
+    else:
+        img_paths = glob.glob(f"{input_path}/**/*.jpg", recursive=True)
+        img_paths.extend(  glob.glob(f"{input_path}/**/*.png", recursive=True) )
+    return img_paths
 
-    print(f"Input: {args.input}")
 
-    class_names = cfg.class_names
 
-    engine, data_pipeline, device = prepare(cfg)
+def frame_results(imgname, img):
+    """ Results of LoadImageFromFile for already decoded <img>. """
+    return dict(img_info=dict(filename=imgname), img_prefix=None, filename=imgname, ori_filename=imgname,
+                img=img, img_shape=img.shape, ori_shape=img.shape, img_fields=['img'])
+
 
+def run(engine, data_pipeline, device, class_names, input_path, save_path, args, frames=None):
+    img_paths = list_images(input_path)
+    os.makedirs(save_path, exist_ok=True)
 
-    if args.input.split('.')[-1] in ('jpg', 'png'):
-        img_paths = [args.input]
+    if frames:  # images are already decoded by run.py, skip LoadImageFromFile
+        # frames of the ring are valid only until the next one is read, loaders work on copies
+        images = ((p, img.copy()) for p, img in read_frames(frames, img_paths, save_path))
+        frame_pipeline = Compose(data_pipeline.transforms[1:])
     else:
-        img_paths = glob.glob(f"{args.input}/**/*.jpg", recursive=True)
-        img_paths.extend(  glob.glob(f"{args.input}/**/*.png", recursive=True) )
+        images = ((p, None) for p in img_paths)
 
-    os.makedirs(args.save_path, exist_ok=True)
+    def load(item):
+        imgname, img = item
+        if img is None:
+            data = dict(img_info=dict(filename=imgname), img_prefix=None)
+            data = data_pipeline(data)
+        else:
+            data = frame_pipeline(frame_results(imgname, img))
+        return imgname, collate([data], samples_per_gpu=1)
+
+    def output(dets_writer, imgname, result):
+        if args.draw:
+            plot_result(result, imgname, class_names)
 
-    output = dict()
+        # tinaface doesn't predict landmarks
+        dets_writer.write(imgname, result[0])
 
-    for imgname in tqdm(img_paths):
+    loaded = prefetch(images, load, args.loaders, args.prefetch)
 
-        data = dict(img_info=dict(filename=imgname), img_prefix=None)
+    # results are written per image, so they survive a crash in the middle of the run
+    with DetsWriter(save_path) as dets_writer, AsyncWriter(output) as writer:
+        for imgname, data in tqdm(loaded, total=len(img_paths)):
+            if device != 'cpu':
+                # scatter to specified GPU
+                data = scatter(data, [device])[0]
+            else:
+                # just get the actual data from DataContainer
+                data['img_metas'] = data['img_metas'][0].data
+                data['img'] = data['img'][0].data
+            result = engine.infer(data['img'], data['img_metas'])[0]
+            writer.write(dets_writer, imgname, result)
 
-        data = data_pipeline(data)
-        data = collate([data], samples_per_gpu=1)
-        if device != 'cpu':
-            # scatter to specified GPU
-            data = scatter(data, [device])[0]
-        else:
-            # just get the actual data from DataContainer
-            data['img_metas'] = data['img_metas'][0].data
-            data['img'] = data['img'][0].data
-        result = engine.infer(data['img'], data['img_metas'])[0]
+    return len(img_paths)
 
-        if args.draw:
-            plot_result(result, imgname, class_names)
 
-        output[imgname] = result[0]
+def main():
 
-    data = []
-    for ipath, bboxes in output.items():
-        line = [ipath, str(len(bboxes)), '$d']
-        for i in range(len(bboxes)):
+    args = _parse_args()
+    cfg = Config.fromfile(args.config)
+    cfg.infer_engine['test_cfg']['score_thr'] = args.thresh
 
-            conf = bboxes[i][-1]
-            bbox = bboxes[i][:-1]
-            bbox = list(map(int, bbox))
-            bbox = list(map(str, bbox))
+    print(f"Input: {args.input}")
 
-            landmarks = np.zeros(10) - 1
-            landmarks = landmarks.astype(int)
-            landmarks = list(map(str, landmarks))
-            line.append(str(conf))
-            line.extend(bbox)
-            line.extend(landmarks)
+    class_names = cfg.class_names
 
-        data.append(' '.join(line))
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    engine, data_pipeline, device = prepare(cfg)
 
-    with open(os.path.join(args.save_path, 'meta.txt'), 'w') as f:
-        f.write('\n'.join(data))
+    if args.serve:
+        def handle(request):
+            if not os.path.exists(request['input']):
+                raise FileNotFoundError(f"Input ({request['input']}) is not visible inside the worker")
+            if not request.get('frames') or args.draw:  # images are read from disk
+                check_visible(list_images(request['input']))
+            if request.get('threads'):
+                torch.set_num_threads(request['threads'])
+            images = run(engine, data_pipeline, device, class_names, request['input'], request['save_path'], args,
+                         request.get('frames'))
+            return {"images": images}
+
+        serve(args.serve, handle)
+    else:
+        run(engine, data_pipeline, device, class_names, args.input, args.save_path, args, args.frames)
 
 
 
@@ -10,48 +10,176 @@
 import argparse
 import os
 import shutil
+from itertools import count, islice
+from multiprocessing import Pool
+from typing import List, Optional, Tuple
 
 from tqdm import tqdm
 import cv2
+import numpy as np
 
 from utils.draw_box import BoxesDrawer
-from utils.io import load_json, dump_json
-from utils.transforms import log_file_to_internal
+from utils.io import load_json, iter_log, split_dets, read_file
+from utils.index import OutputIndex, parse_record
 
 
 def _parse_args():
     parser = argparse.ArgumentParser(); add = parser.add_argument
     add('-i', "--input", type=str, help="Path to output")
     add('-o', "--output", type=str, default='./output/imgs', help="Path to save results")
-    add('-l', "--limit", type=str, default=None, help='Limit number of images to process')
+    add('-l', "--limit", type=int, default=None, help='Limit number of images to process')
+    add("--images", type=str, default=None, help='.txt file with paths of images to process (as they are in output)')
+    add('-w', "--workers", type=int, default=os.cpu_count(), help='Number of processes which render images')
+    add("--unordered", action="store_true", default=False, help='Save images in order they are rendered, '
+                                                                 'not in order of output')
+    add('-p', "--preview", type=int, default=1, choices=sorted(REDUCED_FLAGS),
+        help='Decode images downscaled by this factor (JPEGs are decoded at reduced size directly)')
+    add('-m', "--mosaic", type=int, default=0, help='Tile images into NxN contact sheets instead of saving them one by one')
+    add("--tile", type=int, default=320, help='Size of a mosaic cell, px')
     return parser.parse_args()
 
+REDUCED_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
 
-if __name__ == '__main__':
+_drawer: Optional[BoxesDrawer] = None
 
-    args = _parse_args()
+def _init_worker() -> None:
+    global _drawer
+    _drawer = BoxesDrawer()
+    cv2.setNumThreads(1)  # parallelism comes from processes
+
+def _annotate(ipath, boxes, scores, landmarks, scale: int = 1, fit: int = None) -> Optional[np.ndarray]:
+    """ Decode image downscaled by <scale> (and to fit <fit>x<fit> if given) and draw detections scaled to match. """
+    img = cv2.imread(ipath, REDUCED_FLAGS[scale])
+    if img is None:
+        return None
+    factor = 1 / scale
+    if fit and max(img.shape[:2]) > fit:
+        ratio = fit / max(img.shape[:2])
+        img = cv2.resize(img, (max(1, round(img.shape[1] * ratio)), max(1, round(img.shape[0] * ratio))),
+                         interpolation=cv2.INTER_AREA)
+        factor *= ratio
+    if factor != 1:
+        boxes = (np.asarray(boxes, dtype=float).reshape(-1, 4) * factor).tolist()
+        if landmarks:
+            landmarks = (np.asarray(landmarks, dtype=float) * factor).tolist()
+
+    labels = ['Face']*len(scores)
+    return _drawer.draw(img, boxes, scores, labels, landmarks)
+
+def _render(task) -> Optional[str]:
+    """ Decode, draw and encode one image, returns its path (None if it can't be read). """
+    ipath, boxes, scores, landmarks, output, scale = task
+    img = _annotate(ipath, boxes, scores, landmarks, scale)
+    if img is None:
+        return None
+    iname = ipath.split('/')[-1]
+
+    cv2.imwrite(os.path.join(output, iname), img)
+    return ipath
+
+def _render_sheet(task) -> Tuple[str, List[str]]:
+    """ Tile annotated images into a contact sheet encoded once, returns sheet name and paths of its images. """
+    name, items, output, scale, tile, cols = task
+    rows = -(-len(items) // cols)
+    sheet = np.zeros((rows * tile, cols * tile, 3), dtype=np.uint8)
+    paths = []
+    for ipath, boxes, scores, landmarks in items:
+        img = _annotate(ipath, boxes, scores, landmarks, scale, fit=tile)
+        if img is None:
+            continue
+        y, x = divmod(len(paths), cols)
+        sheet[y * tile: y * tile + img.shape[0], x * tile: x * tile + img.shape[1]] = img
+        cv2.putText(sheet, ipath.split('/')[-1], (x * tile + 2, (y + 1) * tile - 4),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1, cv2.LINE_AA)
+        paths.append(ipath)
+
+    cv2.imwrite(os.path.join(output, name), sheet)
+    return name, paths
+
+def _sheets(data, output: str, scale: int, tile: int, cols: int):
+    data = iter(data)
+    for i in count():
+        items = list(islice(data, cols * cols))
+        if not items:
+            return
+        yield f"sheet_{i:05d}.jpg", items, output, scale, tile, cols
+
+def _read_output(path: str, images: List[str] = None, limit: int = None):
+    """
+    Yields (ipath, boxes, scores, landmarks) of <images> (all by default), at most <limit> ones. Log files are parsed lazily.
+    Images without detections are yielded too (with empty lists), with and without the index.
+    If output has sidecar index (run.py --index or helpers.index_output), only records of needed images are read.
+    """
+    if OutputIndex.exists(path) and (images or limit):
+        index = OutputIndex(path)
+        records = index.records(images) if images else index.in_file_order()
+        for ipath, detections in islice(map(parse_record, records), limit):
+            yield ipath, [det['box'] for det in detections], [det['score'] for det in detections], \
+                  [det['landmarks'] for det in detections]
+        return
 
-    if '.json' in args.input:
-        data = load_json(args.input)
-    elif '.txt' in args.input:
-        data = log_file_to_internal(args.input)
+    wanted = set(images) if images else None
+    data = islice(filter(lambda item: wanted is None or item[0] in wanted, _read_all(path)), limit)
+    yield from data
+
+def _read_all(path: str):
+    if path.endswith('.jsonl'):
+        with open(path) as f:
+            for record in filter(str.strip, f):
+                ipath, detections = parse_record(record.strip())
+                yield ipath, [det['box'] for det in detections], [det['score'] for det in detections], \
+                      [det['landmarks'] for det in detections]
+    elif '.json' in path:
+        for ipath, detections in load_json(path).items():
+            yield ipath, [det['box'] for det in detections], [det['score'] for det in detections], \
+                  [det['landmarks'] for det in detections]
+    elif '.txt' in path:
+        for ipath, rows in iter_log(path):
+            if not len(rows):
+                yield ipath, [], [], []
+                continue
+            detections, landmarks = split_dets(rows)
+            yield ipath, detections[:, :4].astype(int).tolist(), detections[:, 4].tolist(), landmarks.tolist()
     else:
-        raise NotImplementedError(f"Not known format: {args.input}!!!")
+        raise NotImplementedError(f"Not known format: {path}!!!")
+
+
+if __name__ == '__main__':
+
+    args = _parse_args()
+    images = [line.strip() for line in read_file(args.images) if line.strip()] if args.images else None
+    data = _read_output(args.input, images, args.limit)
 
-    drawer = BoxesDrawer()
     if os.path.exists(args.output):
         if input(f"{args.output} folder already exists. Remove and recreate? (yes/no)") == 'yes':
             shutil.rmtree(args.output)
     os.makedirs(args.output, exist_ok=True)
 
-    for ipath, detections in tqdm(data.items(), desc="Images annotating.."):
-        img = cv2.imread(ipath)
-        iname = ipath.split('/')[-1]
+    if args.mosaic > 0:
+        # sheet -> images it shows, to find the original of a sheet cell
+        func, tasks, chunksize = _render_sheet, _sheets(data, args.output, args.preview, args.tile, args.mosaic), 1
+        sheets_file = open(os.path.join(args.output, 'sheets.txt'), 'w')
+    else:
+        func, chunksize, sheets_file = _render, 8, None
+        tasks = ((ipath, boxes, scores, landmarks, args.output, args.preview)
+                 for ipath, boxes, scores, landmarks in data)
+
+    if args.workers > 1:
+        pool = Pool(args.workers, initializer=_init_worker)
+        results = (pool.imap_unordered if args.unordered else pool.imap)(func, tasks, chunksize=chunksize)
+    else:
+        pool = None
+        _init_worker()
+        results = map(func, tasks)
 
-        boxes = [det['box'] for det in detections]
-        scores = [det['score'] for det in detections]
-        landmarks = [det['landmarks'] for det in detections]
-        labels = ['Face']*len(scores)
-        img = drawer.draw(img, boxes, scores, labels, landmarks)
+    for result in tqdm(results, desc="Sheets annotating.." if sheets_file else "Images annotating.."):
+        if sheets_file:
+            name, paths = result
+            sheets_file.write(' '.join([name] + paths) + '\n')
 
-        cv2.imwrite(os.path.join(args.output, iname), img)
+    if sheets_file:
+        sheets_file.close()
+    if pool:
+        pool.close()
+        pool.join()
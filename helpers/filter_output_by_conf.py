@@ -9,7 +9,12 @@
 import argparse
 import os
 
-from utils.io import load_json, dump_json
+import numpy as np
+
+from utils.io import load_json, dump_json, read_file
+from utils.index import OutputIndex, parse_record
+from utils.score_index import ScoreIndex
+from utils.writers import WRITERS, dumps
 
 
 def _parse_args():
@@ -19,21 +24,84 @@ def _parse_args():
 
     add('-o', "--output_path", type=str, default='./output', help="Path to save results")
     add('-f', "--filename", type=str, default=None, help="Name of output file. By default name will be taken from <input>")
+    add("--images", type=str, default=None, help=".txt file with paths of images to keep (as they are in output). "
+                                                 "Only their records are read if output has sidecar index")
+    add("--score_index", action="store_true", default=False,
+        help="Filter with score-sorted index (<input>.scores.npz), it is built on the first use. "
+             "Output is written the same way as run.py writes it. Always used for 'log' format")
+    add("--curve", type=int, default=0, help="Print number of detections and images for <curve> thresholds "
+                                              "evenly spaced in [0, 1] (uses score-sorted index)")
     return parser.parse_args()
 
 
+def _print_curve(index: ScoreIndex, steps: int) -> None:
+    thresholds = np.linspace(0, 1, steps)
+    detections, images = index.count(thresholds)
+    print("thresh\tdetections\timages")
+    for thresh, n_dets, n_imgs in zip(thresholds, detections, images):
+        print(f"{thresh:.4f}\t{n_dets}\t{n_imgs}")
+
+
+def _filter_by_index(index: ScoreIndex, thresh: float, save_path: str, images: list = None) -> None:
+    fmt = 'jsonl' if save_path.endswith('.jsonl') else 'dataset' if save_path.endswith('.json') else 'log'
+    # images whose detections are all filtered out are kept with no detections, as without the index
+    writer = WRITERS[fmt](save_path, keep_empty=True)
+    wanted = set(images) if images else None
+    for ipath, rows in index.filter(thresh):
+        if wanted is None or ipath in wanted:
+            writer.write(ipath, rows[:, :5], rows[:, 5:])
+    writer.close()
+
+
 if __name__ == '__main__':
 
     args = _parse_args()
+    images = [line.strip() for line in read_file(args.images) if line.strip()] if args.images else None
+
+    if args.curve:
+        _print_curve(ScoreIndex.load(args.input), args.curve)
+
+    if args.thresh_conf is None:
+        if not args.curve:
+            raise ValueError("Set <thresh_conf> or <curve>!!!")
+
+    elif args.score_index or args.input.endswith('.txt'):
+        root, ext = os.path.splitext(args.input)
+        file_name = args.filename or f'{root}_filtered_{args.thresh_conf}{ext}'
+        _filter_by_index(ScoreIndex.load(args.input), args.thresh_conf, os.path.join(args.output_path, file_name), images)
+
+    elif args.input.endswith('.jsonl'):
+        # filtered line by line, so memory doesn't depend on size of the output
+        file_name = args.filename or args.input.replace('.jsonl', f'_filtered_{args.thresh_conf}.jsonl')
+        save_path = os.path.join(args.output_path, file_name)
+
+        if images and OutputIndex.exists(args.input):
+            records = OutputIndex(args.input).records(images)
+        else:
+            records = open(args.input)
+        wanted = set(images) if images else None
+        with open(save_path, 'w') as f:
+            for record in filter(str.strip, records):
+                ipath, detections = parse_record(record.strip())
+                if wanted is not None and ipath not in wanted:
+                    continue
+                detections = list(filter(lambda d: d['score'] >= args.thresh_conf, detections))
+                f.write(dumps({"path": ipath, "detections": detections}) + '\n')
+
+    elif '.json' in args.input:
+        if images and OutputIndex.exists(args.input):
+            data = dict(map(parse_record, OutputIndex(args.input).records(images)))
+        else:
+            data = load_json(args.input)
+            if images:
+                data = {ipath: data[ipath] for ipath in images if ipath in data}
 
-    if '.json' in args.input:
-        data = load_json(args.input)
         for ipath, detections in data.items():
             data[ipath] = list(filter(lambda d: d['score'] >= args.thresh_conf, detections))
 
         file_name = args.filename or args.input.replace('.json', f'_filtered_{args.thresh_conf}.json')
-        save_path = os.path.join(args.output, file_name)
+        save_path = os.path.join(args.output_path, file_name)
         dump_json(save_path, data)
 
     else:
-        raise NotImplementedError("Not implemented for 'log' format")
\ No newline at end of file
+        raise NotImplementedError(f"Not known format: {args.input}!!!")
\ No newline at end of file
@@ -0,0 +1,28 @@
+"""
+ File name   : index_output.py
+ Description : Build sidecar byte-offset index (<output>.idx.npy) for result file saved without <--index>.
+
+ Date created : 18.10.2026
+"""
+
+import argparse
+
+from utils.index import build_index, index_path
+from utils.score_index import build_score_index, score_index_path
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(); add = parser.add_argument
+    add('-i', "--input", type=str, help="Path to output (.txt, .json or .jsonl)")
+    add("--scores", action="store_true", default=False, help="Also build score-sorted index (see filter_output_by_conf)")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    args = _parse_args()
+    count = build_index(args.input)
+    print(f"{count} images indexed in {index_path(args.input)}")
+    if args.scores:
+        count = build_score_index(args.input)
+        print(f"{count} detections indexed in {score_index_path(args.input)}")
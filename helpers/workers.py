@@ -0,0 +1,79 @@
+"""
+ File name   : workers.py
+ Description : Start / stop long-lived detector workers which are used by run.py to skip model cold start.
+
+ Date created : 18.10.2026
+"""
+
+import argparse
+import os
+import time
+
+import addict
+
+from utils.io import read_yaml
+from utils.helpers import run_command
+from utils.workers import SOCKETS_DIR, CONTAINER_SOCKETS_DIR, worker_name, socket_path, is_alive
+
+
+SETTINGS_PATH = "settings.yaml"
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(); add = parser.add_argument
+    add('command', type=str, choices=['start', 'stop', 'status'], help="What to do with workers")
+    add('-d', "--data_root", type=str, default=None, help="Root folder of all images workers will be asked to process. "
+                                                           "It is mounted into workers under the same path")
+    add("--detectors", type=str, nargs='+', default=None, help="Detectors to manage. By default all from settings.yaml")
+    add("--timeout", type=float, default=600, help="Seconds to wait for started workers to load models")
+    return parser.parse_args()
+
+
+def _start(detector: str, params: addict.Dict, data_root: str) -> None:
+    cwd = os.getcwd()
+    sockets = os.path.abspath(SOCKETS_DIR)
+    os.makedirs(sockets, exist_ok=True)
+    os.makedirs(f"{cwd}/temp", exist_ok=True)
+
+    tag = params.dir.lower()
+    detector_args = params.get('args', '')
+    sock = f"{CONTAINER_SOCKETS_DIR}/{detector}.sock"
+
+    cmd = f"docker run -d --rm --name {worker_name(detector)} -v {sockets}:{CONTAINER_SOCKETS_DIR} " \
+          f"-v {cwd}/temp:{cwd}/temp -v {data_root}:{data_root} --gpus all {tag} --serve {sock} {detector_args}"
+    print(cmd)
+    run_command(cmd)
+
+
+if __name__ == '__main__':
+
+    args = _parse_args()
+    settings = addict.Dict(read_yaml(SETTINGS_PATH))
+    detectors = args.detectors or list(settings.detectors.keys())
+
+    if args.command == 'start':
+        if not args.data_root:
+            raise ValueError("Specify <data_root> to start workers!!!")
+        data_root = os.path.abspath(args.data_root)
+
+        for detector in detectors:
+            if is_alive(socket_path(detector)):
+                print(f"Worker for ({detector}) is already running")
+                continue
+            _start(detector, settings.detectors[detector], data_root)
+
+        deadline = time.time() + args.timeout
+        pending = [d for d in detectors if not is_alive(socket_path(d))]
+        while pending and time.time() < deadline:
+            time.sleep(1)
+            pending = [d for d in pending if not is_alive(socket_path(d))]
+        if pending:
+            raise RuntimeError(f"Workers ({', '.join(pending)}) did not start in {args.timeout} seconds!!!")
+
+    elif args.command == 'stop':
+        for detector in detectors:
+            run_command(f"docker stop {worker_name(detector)}")
+
+    for detector in detectors:
+        state = "running" if is_alive(socket_path(detector)) else "stopped"
+        print(f"{detector}: {state}")
@@ -1,23 +1,34 @@
 import argparse
 import os
-import glob
 import addict
-from typing import List
-from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
 import logging
 import shutil
+import time
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
-from tqdm import tqdm
 import numpy as np
+from tqdm import tqdm
 
-from utils.io import read_yaml, read_file, dump_json, collect_detections
+from utils.io import read_yaml, list_images, read_dets, remove_dets, split_dets, write_dets_args, read_dets_args
 from utils.helpers import run_command, filter_prefix
-from utils.voting import aggregate_detections
+from utils.voting import aggregate_batch
 from utils.logger import init_logger
+from utils.workers import socket_path, is_alive, request, worker_name
+from utils.scheduler import split_cores, cpuset, run_timed
+from utils.manifest import Manifest
+from utils.streaming import DetsFollower, StreamingAggregator
+from utils.writers import WRITERS
+from utils.frames import FrameRing
+from utils.docker import context_fingerprint, image_fingerprint, build_command
 
 
 SPLIT_CHAR = "P1K2-RSK12aDf215Zzz"
 SETTINGS_PATH = "settings.yaml"
+STREAM_POLL_INTERVAL = 0.5  # seconds
+AGGREGATE_BATCH = 4096  # images voted in one call
 
 
 def _parse_args():
@@ -28,7 +39,25 @@ def _parse_args():
     add('-o', "--output_path", type=str, default='./output', help="Path to save results")
     add('-f', "--filename", type=str, default=None, help="Name of output file. By default name will be taken from <input>")
     add('--keep_temp', action="store_true", default=False, help="If specified - temp not aggregated detectors metadata will be saved")
-    add('--save_format', type=str, default="dataset", help="Output format: <dataset> or <log>")
+    add('--no_build', action="store_true", default=False, help="Don't check and build detector images. "
+                                                                  "Use when images are already built")
+    add('--no_workers', action="store_true", default=False, help="Don't use running detector workers, "
+                                                                    "always start new containers")
+    add('--manifest', type=str, default='./cache/manifest.sqlite', help="Cache of per-image detector results. "
+                                                                          "Only not cached images are processed")
+    add('--content_hash', action="store_true", default=False, help="Identify images in cache by content hash "
+                                                                      "instead of size and mtime")
+    add('--no_cache', action="store_true", default=False, help="Process all images even if they are cached")
+    add('--sequential', action="store_true", default=False, help="Run detectors one after another on all cores")
+    add('--stream', action="store_true", default=False, help="Aggregate and save every image as soon as all "
+                                                                "detectors processed it")
+    add('--shared_decode', action="store_true", default=False, help="Decode every image once into shared memory-mapped "
+                                                                       "frame ring instead of decoding it in every detector")
+    add('--frames_buffer', type=int, default=2048, help="Size of the shared frame ring in MB")
+    add('--decode_threads', type=int, default=4, help="Number of threads which decode images for the frame ring")
+    add('--save_format', type=str, default="dataset", help="Output format: <dataset>, <jsonl> or <log>")
+    add('--index', action="store_true", default=False, help="Save sidecar <output>.idx.npy index, so tools can read "
+                                                              "results of single images without reading whole output")
     return parser.parse_args()
 
 def _sanity_check(args, settings: addict.Dict) -> None:
@@ -42,11 +71,71 @@ def _sanity_check(args, settings: addict.Dict) -> None:
             raise ValueError(f"Create Dockerfile for ({detector}) detector!!!")
         if "entrypoint.sh" not in os.listdir(os.path.join("./detectors", params.dir)):
             raise ValueError(f"Create entrypoint.sh for ({detector}) detector!!!")
-    if args.save_format not in ('dataset', 'log'):
-        raise ValueError(f"<save_format> can be eather 'dataset' or 'log', not ({args.save_format})!!!")
+    if args.save_format not in WRITERS:
+        raise ValueError(f"<save_format> can be one of {list(WRITERS)}, not ({args.save_format})!!!")
+    if args.shared_decode and args.sequential:
+        raise ValueError("<shared_decode> needs all detectors reading the frame ring at the same time, "
+                         "it can't be used with <sequential>!!!")
     if args.prefix and args.prefix not in args.input:
         raise ValueError(f"Prefix ({args.prefix}) doesn't exist in input path ({args.input})!!!")
 
+def _infer(detector: str, params: addict.Dict, save_folder: str, img_paths: List[str], cores: List[int],
+           frames: Optional[str], args, logger) -> None:
+    tag = params.dir.lower()
+    detector_args = params.get('args', '')
+    threads = len(cores)
+
+    # detectors accept .txt file with image paths as input, so only not cached images are processed
+    with open(f"{save_folder}/images.txt", 'w') as f:
+        f.write('\n'.join(img_paths))
+    # results left by a crash are cached under the args they were produced with, even if settings change
+    write_dets_args(save_folder, detector_args)
+
+    sock = socket_path(detector)
+    if not args.no_workers and is_alive(sock):
+        logger.log(logging.INFO, f"Sending {len(img_paths)} images to ({detector}) worker on {threads} threads")
+        run_command(f"docker update --cpuset-cpus {cpuset(cores)} {worker_name(detector)}", prefix=f"[{detector}] ")
+        request(sock, {"input": f"{save_folder}/images.txt", "save_path": save_folder, "threads": threads,
+                       "frames": frames})
+        return
+
+    input_ = os.path.abspath(args.input)
+    frames_args = f"-v {frames}:{frames}" if frames else ''
+    cmd = f"docker run -v {save_folder}:/root/outputs -v {input_}:{input_} {frames_args} --rm --gpus all " \
+          f"--cpuset-cpus {cpuset(cores)} -e OMP_NUM_THREADS={threads} -e MKL_NUM_THREADS={threads} " \
+          f"{tag} -i /root/outputs/images.txt --threads {threads} {detector_args}"
+    if frames:
+        cmd += f" --frames {frames}"
+    logger.log(logging.INFO, cmd)
+    run_command(cmd, prefix=f"[{detector}] ")
+
+def _run_and_set(job: Callable[[], None], event: threading.Event) -> None:
+    try:
+        job()
+    finally:
+        event.set()
+
+def _ingest(manifest: Manifest, detector: str, save_folder: str, stamps: dict) -> int:
+    """
+    Move results written by detector (also partial ones of crashed runs) into manifest under the args they were
+    produced with. Results with unknown args are dropped.
+    """
+    detector_args = read_dets_args(save_folder)
+    count = 0
+    if detector_args is not None:
+        # only complete index lines are read: detector could die in the middle of writing the line
+        count = manifest.add(detector, detector_args, read_dets(save_folder), stamps)
+    remove_dets(save_folder)
+    return count
+
+def _infer_and_ingest(detector: str, params: addict.Dict, save_folder: str, img_paths: List[str], cores: List[int],
+                      frames: Optional[str], manifest: Manifest, stamps: dict, args, logger) -> None:
+    try:
+        _infer(detector, params, save_folder, img_paths, cores, frames, args, logger)
+    finally:
+        count = _ingest(manifest, detector, save_folder, stamps)
+        logger.log(logging.INFO, f"{detector}: {count}/{len(img_paths)} images processed")
+
 if __name__ == '__main__':
 
     args = _parse_args()
@@ -62,10 +151,17 @@ if __name__ == '__main__':
 
     # BUILD
     logger.log(logging.INFO, "Start building ...")
-    for detector in tqdm(detectors, desc="Building images"):
+    for detector in tqdm([] if args.no_build else detectors, desc="Building images"):
         dir_ = settings.detectors[detector].dir
         tag = dir_.lower()
-        cmd = f"docker build --rm --tag {tag} ./detectors/{dir_}"
+        context = f"./detectors/{dir_}"
+
+        # sending context with weights to docker daemon takes long even if all layers are cached
+        fingerprint = context_fingerprint(context)
+        if image_fingerprint(tag) == fingerprint:
+            logger.log(logging.INFO, f"Image <{tag}> is up to date")
+            continue
+        cmd = build_command(tag, context, fingerprint)
         logger.log(logging.INFO, cmd)
         run_command(cmd)
 
@@ -76,92 +172,142 @@ if __name__ == '__main__':
 
     dataset = SPLIT_CHAR.join( args.input.split('/') )
 
-    for detector in tqdm(detectors):
+    weights = {detector: settings.detectors[detector].get('weight', 1.0) for detector in detectors}
+    cores = split_cores(weights, settings.get('num_threads', 0))
+    if args.sequential:
+        all_cores = list(range(settings.get('num_threads', 0) or os.cpu_count()))
+        cores = {detector: all_cores for detector in detectors}
+
+    img_paths = list_images(args.input)
+    manifest = Manifest(args.manifest, args.content_hash)
+    stamps = manifest.stamps(img_paths)
+
+    frames = f"{cwd}/temp/{dataset}/frames" if args.shared_decode else None
+    save_folders, jobs, todos = dict(), dict(), dict()
+    for detector in detectors:
         save_folder = f"{cwd}/temp/{dataset}/{detector}"
         os.makedirs(save_folder, exist_ok=True)
-
-        dir_ = settings.detectors[detector].dir
-        tag = dir_.lower()
+        save_folders[detector] = save_folder
         detector_args = settings.detectors[detector].get('args', '')
 
-        cmd = f"docker run -v {save_folder}:/root/outputs -v {args.input}:{args.input} --rm --gpus all {tag} -i {args.input} {detector_args}"
-        logger.log(logging.INFO, cmd)
-        run_command(cmd)
-
-
-    # AGGREGATE
-    logger.log(logging.INFO, "Start aggregating ...")
-    dataset = SPLIT_CHAR.join(args.input.split('/'))
-    path = f"{cwd}/temp/{dataset}"
-
-    # read logs for all detections for current dataset
-    det_logs = glob.glob(f"{path}/*/*.txt")
-    det_logs = list(map(read_file, det_logs))
-
-    # collect detections for each image in each log
-    detections_dicts: List[dict] = list(map(collect_detections, det_logs))
-
-    # merge all detectors outputs based on image
-    detections_dict_merged = dict()
-    for detections_dict in detections_dicts:
-        for img, (dets, lndms) in detections_dict.items():
-            if img in detections_dict_merged:
-                detections_dict_merged[img][0].extend(dets)
-                detections_dict_merged[img][1].extend(lndms)
-            else:
-                detections_dict_merged[img] = [dets, lndms]
-
-    # aggregate detections with voting (nms-like) algorithm.
-    detections_dict_aggregated = dict()
-    for img, (dets, lndms) in detections_dict_merged.items():
-        detections_dict_aggregated[img] = aggregate_detections(dets, lndms, settings.thresh_iou, settings.min_votes)
-
-
-    # SAVE
-    logger.log(logging.INFO, f"Start saving in <{args.save_format}> format ...")
+        # results left by interrupted run
+        _ingest(manifest, detector, save_folder, stamps)
+        todo = list(stamps) if args.no_cache else manifest.missing(detector, detector_args, stamps)
+        logger.log(logging.INFO, f"{detector}: {len(img_paths) - len(todo)}/{len(img_paths)} images are cached")
+        if not todo:
+            continue
+
+        todos[detector] = set(todo)
+        if args.stream:  # results are ingested by the streaming loop
+            jobs[detector] = partial(_infer, detector, settings.detectors[detector], save_folder, todo,
+                                     cores[detector], frames, args, logger)
+        else:
+            jobs[detector] = partial(_infer_and_ingest, detector, settings.detectors[detector], save_folder, todo,
+                                     cores[detector], frames, manifest, stamps, args, logger)
+
+    def _run_jobs() -> Dict[str, float]:
+        if not (frames and jobs):
+            return run_timed(jobs, parallel=not args.sequential)
+
+        # DECODE: every image is decoded once into shared frame ring, detectors read frames from it
+        ring = FrameRing(frames, args.frames_buffer << 20, {d: f"{save_folders[d]}/frames.pos" for d in jobs})
+        finished = {detector: threading.Event() for detector in jobs}
+        to_decode = [p for p in img_paths if any(p in todo for todo in todos.values())]
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            decoder = pool.submit(ring.write_all, to_decode, lambda d: finished[d].is_set(), args.decode_threads)
+            try:
+                return run_timed({d: partial(_run_and_set, job, finished[d]) for d, job in jobs.items()},
+                                 parallel=True)
+            finally:
+                decoder.result()
+                ring.close()
 
     save_filename = args.filename or list(filter(len, args.input.split('/')))[-1]
     os.makedirs(args.output_path, exist_ok=True)
     save_path = os.path.join(args.output_path, save_filename)
 
-    if args.save_format == 'dataset':
-        data = defaultdict(list)
-        for ipath, (bboxes, kpss) in detections_dict_aggregated.items():
-            for d, l in zip(bboxes, kpss):
-                item = {"box": list(d[:4]), "score": float(d[4]), "landmarks": list(l)}
-                ipath = filter_prefix(ipath, args.prefix)
-                data[ipath].append(item)
-
-        if '.json' not in save_path:
-            save_path += '.json'
-        dump_json(save_path, data)
+    writer_cls = WRITERS[args.save_format]
+    if not save_path.endswith(writer_cls.ext):
+        save_path += writer_cls.ext
+    writer = writer_cls(save_path, index=args.index)
+
+    def _write_aggregated(imgs: List[str], rows: List[np.ndarray]) -> None:
+        """ Aggregate detections of many images in one batched call and save them. """
+        if not imgs:
+            return
+        segments = np.cumsum([0] + [len(r) for r in rows])
+        dets, lndms = split_dets(np.concatenate(rows))
+        keeps = aggregate_batch(dets, lndms, segments, settings.thresh_iou, settings.min_votes)
+        for img, start, keep in zip(imgs, segments, keeps):
+            writer.write(filter_prefix(img, args.prefix), dets[start + keep], lndms[start + keep])
+
+    if args.stream:
+        # INFER + AGGREGATE + SAVE: every image is aggregated and saved as soon as all detectors reported it
+        logger.log(logging.INFO, f"Start infering with streaming aggregation in <{args.save_format}> format ...")
+        ready: List[Tuple[str, np.ndarray]] = []
+        aggregator = StreamingAggregator(detectors, lambda img, rows: ready.append((img, rows)))
+
+        def _feed(detector: str, dets: List[Tuple[str, np.ndarray]]) -> None:
+            for img, rows in dets:
+                aggregator.add(detector, img, rows)
+
+        def _drain() -> None:
+            """ Images which got ready since the last poll are aggregated together. """
+            _write_aggregated([img for img, _ in ready], [rows for _, rows in ready])
+            ready.clear()
+
+        for detector in detectors:
+            if detector not in jobs or not args.no_cache:
+                _feed(detector, manifest.detections(detector, settings.detectors[detector].get('args', ''), stamps))
+
+        followers = {detector: DetsFollower(save_folders[detector]) for detector in jobs}
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            future = pool.submit(_run_jobs)
+            while True:
+                finished = future.done()
+                for detector, follower in followers.items():
+                    dets = follower.read_new()
+                    manifest.add(detector, settings.detectors[detector].get('args', ''), dets, stamps)
+                    _feed(detector, dets)
+                _drain()
+                if finished:
+                    break
+                time.sleep(STREAM_POLL_INTERVAL)
+            wall_times = future.result()
+
+        aggregator.flush()
+        _drain()
+        for detector in followers:
+            remove_dets(save_folders[detector])
+        manifest.close()
 
     else:
-        data = []
-        for ipath, (bboxes, kpss) in detections_dict_aggregated.items():
-            ipath = filter_prefix(ipath, args.prefix)
-            line = [ipath, str(len(bboxes)), '$d']
-            for i in range(len(bboxes)):
-                conf = bboxes[i][-1]
-                bbox = bboxes[i][:-1]
-                bbox = list(map(int, bbox))
-                bbox = list(map(str, bbox))
-
-                landmarks = np.array(kpss[i]).astype(int).flatten()
-                landmarks = list(map(str, landmarks))
-                line.append(str(conf))
-                line.extend(bbox)
-                line.extend(landmarks)
-
-            data.append(' '.join(line))
-
-        if '.txt' not in save_path:
-            save_path += '.txt'
-
-        with open(save_path, 'w') as f:
-            f.write('\n'.join(data))
-
+        # INFER
+        wall_times = _run_jobs()
+
+        # AGGREGATE
+        logger.log(logging.INFO, "Start aggregating ...")
+
+        # aggregate detections with voting (nms-like) algorithm and SAVE
+        logger.log(logging.INFO, f"Start saving in <{args.save_format}> format ...")
+        for i in range(0, len(img_paths), AGGREGATE_BATCH):
+            # merge cached outputs of all detectors for a batch of images, so memory doesn't depend on the dataset
+            batch_stamps = {img: stamps[img] for img in img_paths[i: i + AGGREGATE_BATCH]}
+            merged: Dict[str, List[np.ndarray]] = dict()
+            for detector in detectors:
+                detector_args = settings.detectors[detector].get('args', '')
+                for img, rows in manifest.detections(detector, detector_args, batch_stamps):
+                    merged.setdefault(img, []).append(rows)
+            batch = [img for img in batch_stamps if img in merged]
+            _write_aggregated(batch, [np.concatenate(merged[img]) for img in batch])
+        manifest.close()
+
+    writer.close()
+
+    for detector, wall_time in wall_times.items():
+        logger.log(logging.INFO, f"{detector}: {wall_time:.1f}s on {len(cores[detector])} threads")
 
     # CLEAN UP
     if not args.keep_temp:
-        shutil.rmtree(f"{cwd}/temp")
+        # keep <temp> itself: it is mounted into running workers
+        shutil.rmtree(f"{cwd}/temp/{dataset}")
@@ -0,0 +1,44 @@
+"""
+ File name   : test_voting.py
+ Description : Batched voting (aggregate_batch) must give exactly the per-image result of aggregate_detections.
+
+ Date created : 18.10.2026
+"""
+
+import numpy as np
+import pytest
+
+from utils import voting
+from utils.voting import aggregate_batch, aggregate_detections
+
+
+THRESH_IOU, MIN_VOTES = [0.8, 0.5], [2, 1]
+
+
+def _random_batch(rng, counts):
+    segments = np.concatenate([[0], np.cumsum(counts)])
+    n = segments[-1]
+    xy = rng.integers(0, 200, (n, 2)).astype(np.float64)
+    wh = rng.integers(0, 60, (n, 2)).astype(np.float64)  # zero sizes give degenerate boxes
+    scores = rng.choice([0.3, 0.5, 0.9], n) if n else np.empty(0)  # ties in scores
+    detections = np.hstack([xy, xy + wh, scores[:, None]])
+    landmarks = np.where(rng.uniform(size=(n, 1)) < 0.5, 1.0, -1.0) * np.ones((n, 10))
+    return detections, landmarks, segments
+
+
+@pytest.mark.parametrize('cells', [1, 64, 1 << 16])
+def test_chunked_batch_matches_per_image(monkeypatch, cells):
+    # small budgets split every size bucket into many chunks, down to one image per chunk
+    monkeypatch.setattr(voting, 'LOCKSTEP_CELLS', cells)
+    rng = np.random.default_rng(cells)
+    counts = np.concatenate([rng.integers(0, 65, 300), [0, 1, 100]])  # 100 boxes are voted one by one
+    detections, landmarks, segments = _random_batch(rng, counts)
+
+    keeps = aggregate_batch(detections, landmarks, segments, THRESH_IOU, MIN_VOTES)
+
+    assert len(keeps) == len(counts)
+    for start, end, keep in zip(segments[:-1], segments[1:], keeps):
+        expected, expected_landmarks = aggregate_detections(detections[start: end], landmarks[start: end],
+                                                            THRESH_IOU, MIN_VOTES)
+        np.testing.assert_array_equal(detections[start + keep], expected)
+        np.testing.assert_array_equal(landmarks[start + keep], expected_landmarks)
@@ -0,0 +1,39 @@
+"""
+ File name   : docker.py
+ Description : Skip rebuilding of detector images when their build context didn't change.
+
+ Date created : 18.10.2026
+"""
+
+import os
+import hashlib
+import subprocess
+from typing import Optional
+
+
+FINGERPRINT_LABEL = "detanator.fingerprint"
+
+
+def context_fingerprint(path: str) -> str:
+    """ Hash of relative paths, sizes and mtimes of all files of the build context. Contents are not read. """
+    h = hashlib.sha1()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            fp = os.path.join(root, name)
+            st = os.stat(fp)
+            h.update(f"{os.path.relpath(fp, path)}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+    return h.hexdigest()
+
+
+def image_fingerprint(tag: str) -> Optional[str]:
+    """ Fingerprint of the context the image <tag> was built from, None if there is no such image. """
+    cmd = ["docker", "image", "inspect", "--format", f'{{{{ index .Config.Labels "{FINGERPRINT_LABEL}" }}}}', tag]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if result.returncode != 0:
+        return None
+    return result.stdout.decode().strip() or None
+
+
+def build_command(tag: str, context: str, fingerprint: str) -> str:
+    return f"docker build --rm --label {FINGERPRINT_LABEL}={fingerprint} --tag {tag} {context}"
@@ -1,9 +1,18 @@
 from PIL import Image, ImageDraw, ImageFont
 import numpy as np
 import os
+from functools import lru_cache
 from typing import List
 
 
+@lru_cache(maxsize=64)
+def load_font(path: str, size: int) -> ImageFont.ImageFont:
+    """ Fonts are cached per size: loading font file for every box is slower than drawing it. """
+    if not os.path.exists(path):
+        return ImageFont.load_default()
+    return ImageFont.truetype(path, size)
+
+
 class ColorMap(object):
     def __init__(self, num):
         super().__init__()
@@ -62,11 +71,11 @@ class BoxesDrawer:
             xmin, ymin, xmax, ymax = bbox
 
             font_size = max(int((xmax - xmin) // 6), 10)
-            font = ImageFont.truetype(self.font_path, font_size)
+            font = load_font(self.font_path, font_size)
 
             text = "{} {:.4f}".format(label, score)
-            th = sum(font.getmetrics())
-            tw = font.getsize(text)[0]
+            th = sum(font.getmetrics()) if hasattr(font, 'getmetrics') else font_size
+            tw = font.getlength(text)
             start_y = max(0, ymin - th)
 
 
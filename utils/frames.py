@@ -0,0 +1,100 @@
+"""
+ File name   : frames.py
+ Description : Shared decode stage: every image is decoded once into a memory-mapped ring buffer which all detectors read.
+
+ Ring directory layout (readers live in detectors/*/frames.py):
+    frames.bin - memory-mapped buffer with decoded uint8 BGR frames
+    index.tsv  - "seq path offset height width" line per frame, appended after the frame is written; "END" closes the ring
+ Every reader reports the last frame it released in <its save folder>/frames.pos.
+
+ Date created : 18.10.2026
+"""
+
+import os
+import time
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+import cv2
+import numpy as np
+
+
+POLL_INTERVAL = 0.01  # seconds
+
+
+def _read_pos(path: str) -> int:
+    try:
+        with open(path) as f:
+            return int(f.read() or -1)
+    except (OSError, ValueError):
+        return -1
+
+
+class FrameRing:
+    """ <readers> maps reader name to its frames.pos file. Create the ring before readers are started. """
+    def __init__(self, ring_dir: str, capacity: int, readers: Dict[str, str]):
+        os.makedirs(ring_dir, exist_ok=True)
+        self.ring_dir = ring_dir
+        self.capacity = capacity
+        self.readers = readers
+        for path in readers.values():
+            if os.path.exists(path):
+                os.remove(path)
+        self.buffer = np.memmap(os.path.join(ring_dir, 'frames.bin'), dtype=np.uint8, mode='w+', shape=(capacity,))
+        self.index = open(os.path.join(ring_dir, 'index.tsv'), 'w')
+        self.in_flight = deque()  # (seq, offset, size) of frames not released by all readers yet
+        self.cursor = 0
+
+    def write_all(self, img_paths: List[str], is_finished: Callable[[str], bool], num_threads: int = 4) -> int:
+        """ Decode <img_paths> with <num_threads> threads and put them into the ring in order. Finished readers don't hold frames. """
+        written = 0
+        try:
+            with ThreadPoolExecutor(max_workers=num_threads) as pool:
+                pending = deque()
+                for path in img_paths:
+                    pending.append((path, pool.submit(cv2.imread, path, cv2.IMREAD_COLOR)))
+                    if len(pending) < num_threads * 2:
+                        continue
+                    written += self._put(*pending.popleft(), is_finished, seq=written)
+                while pending:
+                    written += self._put(*pending.popleft(), is_finished, seq=written)
+        finally:
+            # readers wait for the end marker
+            self.index.write('END\n')
+            self.index.flush()
+        return written
+
+    def _put(self, path: str, future, is_finished: Callable[[str], bool], seq: int) -> int:
+        img = future.result()
+        if img is None:
+            logging.getLogger(__name__).warning(f"Can't decode ({path}), skipped")
+            return 0
+        size = img.size
+        if size > self.capacity:
+            raise ValueError(f"Frame of ({path}) is bigger than frame ring ({self.capacity} bytes)!!!")
+
+        offset = self.cursor if self.cursor + size <= self.capacity else 0
+        self._wait_free(offset, offset + size, is_finished)
+
+        self.buffer[offset: offset + size] = img.reshape(-1)
+        self.index.write(f"{seq}\t{path}\t{offset}\t{img.shape[0]}\t{img.shape[1]}\n")
+        self.index.flush()
+        self.in_flight.append((seq, offset, size))
+        self.cursor = offset + size
+        return 1
+
+    def _wait_free(self, start: int, end: int, is_finished: Callable[[str], bool]) -> None:
+        while True:
+            active = [_read_pos(path) for name, path in self.readers.items() if not is_finished(name)]
+            released = min(active) if active else float('inf')
+            while self.in_flight and self.in_flight[0][0] <= released:
+                self.in_flight.popleft()
+            if not any(offset < end and start < offset + size for _, offset, size in self.in_flight):
+                return
+            time.sleep(POLL_INTERVAL)
+
+    def close(self) -> None:
+        self.index.close()
+        del self.buffer
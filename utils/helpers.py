@@ -11,7 +11,7 @@ import shlex
 import subprocess
 
 
-def run_command(command):
+def run_command(command, prefix: str = ''):
     process = subprocess.Popen(shlex.split(command), shell=False, stdout=subprocess.PIPE)
     # Poll process.stdout to show stdout live
     while True:
@@ -19,7 +19,7 @@ def run_command(command):
         if process.poll() is not None:
             break
         if output:
-            print(output.strip())
+            print(prefix + output.strip())
     rc = process.poll()
 
 def filter_prefix(path: str, prefix: Optional[str]) -> str:
@@ -0,0 +1,113 @@
+"""
+ File name   : index.py
+ Description : Sidecar index of result files: image path -> byte offset and length of its record, so tools can read
+               results of a few images without reading the whole file.
+
+ <output>.idx.npy - array of (hash, offset, length) sorted by hash, hash is 8 bytes of blake2b of image path.
+ All result formats keep a record per line: "path count $d ..." for <log>, "path": [...] for <dataset>,
+ {"path": "...", "detections": [...]} for <jsonl>.
+
+ Date created : 18.10.2026
+"""
+
+import os
+import json
+import hashlib
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from utils.io import parse_log
+
+
+INDEX_DTYPE = np.dtype([('hash', '<u8'), ('offset', '<i8'), ('length', '<i8')])
+
+
+def index_path(output_path: str) -> str:
+    return output_path + '.idx.npy'
+
+
+def path_hash(ipath: str) -> int:
+    return int.from_bytes(hashlib.blake2b(ipath.encode(), digest_size=8).digest(), 'little')
+
+
+def save_index(output_path: str, entries: List[Tuple[int, int, int]]) -> None:
+    index = np.array(entries, dtype=INDEX_DTYPE)
+    index.sort(order='hash')
+    np.save(index_path(output_path), index)
+
+
+def build_index(output_path: str) -> int:
+    """ Index an existing result file (written with a record per line). Returns number of indexed images. """
+    entries = []
+    with open(output_path, 'rb') as f:
+        offset = 0
+        for line in f:
+            if not offset and output_path.endswith('.json') and line.strip() not in (b'{', b'{}'):
+                raise ValueError(f"({output_path}) is not written with a record per line, it can't be indexed!!!")
+            record = line.rstrip(b'\r\n').rstrip(b',')
+            if record and record not in (b'{', b'}', b'{}'):
+                entries.append((path_hash(record_path(record.decode())), offset, len(record)))
+            offset += len(line)
+    save_index(output_path, entries)
+    return len(entries)
+
+
+def record_path(record: str) -> str:
+    if record.startswith('{'):  # <jsonl>, path is the first key
+        return json.JSONDecoder().raw_decode(record, record.index(':') + 1)[0]
+    if record.startswith('"'):  # <dataset>
+        return json.JSONDecoder().raw_decode(record)[0]
+    return record.partition(' $d')[0].rsplit(' ', 1)[0]  # <log>
+
+
+def parse_record(record: str) -> Tuple[str, list]:
+    """ Record of any format to (ipath, [{"box": [...], "score": .., "landmarks": [...]}, ...]). """
+    if record.startswith('{'):
+        record = json.loads(record)
+        return record['path'], record['detections']
+    if record.startswith('"'):
+        return next(iter(json.loads('{' + record + '}').items()))
+    ipath, rows = next(parse_log([record]))
+    # the same rounding as utils/transforms.log_to_json
+    return ipath, [{"box": r[:4].astype(int).tolist(), "score": float(r[4]), "landmarks": r[5:].tolist()} for r in rows]
+
+
+class OutputIndex:
+    """ Memory-mapped lookup of records of a result file by image path. """
+    def __init__(self, output_path: str):
+        self.output_path = output_path
+        self.index = np.load(index_path(output_path), mmap_mode='r')
+
+    @staticmethod
+    def exists(output_path: str) -> bool:
+        return os.path.exists(index_path(output_path))
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def get(self, ipath: str) -> Optional[str]:
+        for record in self._read(self._find(path_hash(ipath))):
+            if record_path(record) == ipath:  # hashes of different paths can collide
+                return record
+        return None
+
+    def records(self, ipaths: Iterable[str]) -> Iterator[str]:
+        for ipath in ipaths:
+            record = self.get(ipath)
+            if record is not None:
+                yield record
+
+    def in_file_order(self) -> Iterator[str]:
+        """ Records are read lazily, so taking first few of them reads only them. """
+        yield from self._read(np.argsort(self.index['offset'], kind='stable'))
+
+    def _find(self, h: int) -> range:
+        hashes = self.index['hash']
+        return range(np.searchsorted(hashes, np.uint64(h), side='left'), np.searchsorted(hashes, np.uint64(h), side='right'))
+
+    def _read(self, positions: Iterable[int]) -> Iterator[str]:
+        with open(self.output_path, 'rb') as f:
+            for i in positions:
+                f.seek(int(self.index['offset'][i]))
+                yield f.read(int(self.index['length'][i])).decode()
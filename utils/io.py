@@ -6,9 +6,23 @@
  Author:  Ihar Khakholka
 """
 
+import os
+import glob
 import yaml
 import json
-from typing import Tuple, List
+from itertools import islice
+from typing import Iterable, Iterator, Tuple, List, Optional
+
+import numpy as np
+
+
+DET_SIZE = 1 + 4 + 10
+# binary detector output (see detectors/*/dets.py) and text log of detectors which don't support it
+DETS_BIN, DETS_INDEX, META = 'dets.bin', 'dets.tsv', 'meta.txt'
+# args of the detector which produced the output in the folder
+DETS_ARGS = 'dets.args'
+# columns of "conf x1 y1 x2 y2 l1..l10" log detection in binary rows
+LOG_COLUMNS = [1, 2, 3, 4, 0] + list(range(5, DET_SIZE))
 
 
 def read_yaml(path: str) -> dict:
@@ -23,6 +37,17 @@ def read_file(path: str) -> List[str]:
         data = f.readlines()
     return data
 
+def list_images(path: str) -> List[str]:
+    """ The same input rules as detectors use: single image, folder (recursive) or .txt file with image paths. """
+    if path.split('.')[-1] in ('jpg', 'png'):
+        img_paths = [path]
+    elif path.endswith('.txt'):
+        img_paths = [line.strip() for line in read_file(path) if line.strip()]
+    else:
+        img_paths = glob.glob(f"{path}/**/*.jpg", recursive=True)
+        img_paths.extend(  glob.glob(f"{path}/**/*.png", recursive=True) )
+    return [os.path.abspath(p) for p in img_paths]
+
 def dump_json(fp: str, data: dict):
     with open(fp, 'w') as f:
         json.dump(data, f)
@@ -32,42 +57,118 @@ def load_json(fp: str) -> dict:
         data = json.load(f)
     return data
 
-def parse_line(line: str) -> Tuple[str, List[list], List[list]]:
-    detections = []
-    landmarks = []
-
-    det_size = 1 + 4 + 10
-
-    img = line.split(' ')[0]
-    count = int(line.split(' ')[1])
-    line = line.split("$d")[1].strip().split(' ')
-
-    for i in range(count):
-        det_raw = line[i * det_size: (i + 1) * det_size]
-        points = [float(p) for p in det_raw[5:]]
-        x1 = min(int(det_raw[1]), int(det_raw[3]))
-        x2 = max(int(det_raw[1]), int(det_raw[3]))
-        y1 = min(int(det_raw[2]), int(det_raw[4]))
-        y2 = max(int(det_raw[2]), int(det_raw[4]))
-        score = float(det_raw[0])
+def parse_log(lines: Iterable[str], chunk: int = 4096) -> Iterator[Tuple[str, np.ndarray]]:
+    """
+    Lazily parse "path count $d conf x1 y1 x2 y2 l1..l10 ..." log lines into (path, [count, 15] rows
+    "x1 y1 x2 y2 score l1..l10" of binary format). Numbers of <chunk> lines are tokenized by NumPy in one call.
+    Rows are float64: scores keep all digits of the log (as float() parses them), coordinates are integers anyway.
+    """
+    lines = iter(lines)
+    while True:
+        paths, counts, numbers = [], [], []
+        for line in islice(lines, chunk):
+            head, _, numeric = line.strip().partition('$d')
+            if not head:
+                continue
+            path, count = head.rstrip().rsplit(' ', 1)
+            paths.append(path)
+            counts.append(int(count))
+            numbers.append(numeric)
+        if not paths:
+            return
+
+        values = np.fromstring(' '.join(numbers), dtype=np.float64, sep=' ')
+        if values.size != sum(counts) * DET_SIZE:
+            raise ValueError(f"Broken log line near ({paths[0]})!!!")
+        rows = values.reshape(-1, DET_SIZE)[:, LOG_COLUMNS]
+
+        offsets = np.cumsum([0] + counts)
+        for i, path in enumerate(paths):
+            yield path, rows[offsets[i]: offsets[i + 1]]
+
+
+def iter_log(path: str) -> Iterator[Tuple[str, np.ndarray]]:
+    """ parse_log of a log file, the file is read lazily. """
+    with open(path) as f:
+        yield from parse_log(f)
 
-        detections.append([x1, y1, x2, y2, score])
-        landmarks.append(points)
 
-    return img, detections, landmarks
+def parse_line(line: str) -> Tuple[str, List[list], List[list]]:
+    img, rows = line_to_dets(line)
+    detections, landmarks = split_dets(rows)
+    return img, detections.tolist(), landmarks.tolist()
 
 
 def collect_detections(detections_log: List[str], prefix_path: str = None) -> dict:
     output = dict()
 
-    for line in detections_log:
-        img, detections, landmarks = parse_line(line)
+    for img, rows in parse_log(detections_log):
+        detections, landmarks = split_dets(rows)
 
         if prefix_path:
             img = img[img.find(prefix_path):]
 
-        output[img] = [detections, landmarks]
+        output[img] = [detections.tolist(), landmarks.tolist()]
+
+    return output
+
 
+def line_to_dets(line: str) -> Tuple[str, np.ndarray]:
+    """ Text log line to [count, 15] float64 rows "x1 y1 x2 y2 score l1..l10" of binary format. """
+    return next(parse_log([line]))
+
+
+def split_dets(rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """ Rows of binary format to [n, 5] detections with ordered corners and [n, 10] landmarks. """
+    rows = rows.reshape(-1, DET_SIZE).astype(np.float64)
+    detections = np.stack([np.minimum(rows[:, 0], rows[:, 2]), np.minimum(rows[:, 1], rows[:, 3]),
+                           np.maximum(rows[:, 0], rows[:, 2]), np.maximum(rows[:, 1], rows[:, 3]), rows[:, 4]], axis=1)
+    return detections, rows[:, 5:]
+
+
+def read_index_lines(path: str) -> List[str]:
+    """ Complete lines only: a line without newline is still being written (or writer died). """
+    if not os.path.exists(path):
+        return []
+    lines = read_file(path)
+    if lines and not lines[-1].endswith('\n'):
+        lines = lines[:-1]
+    return [line for line in lines if line.strip()]
+
+
+def read_dets(folder: str) -> List[Tuple[str, np.ndarray]]:
+    """ (path, [count, 15] rows) of every image a detector wrote to <folder>, in binary or text format. """
+    output = []
+    index = read_index_lines(os.path.join(folder, DETS_INDEX))
+    if index:
+        bin_path = os.path.join(folder, DETS_BIN)
+        # detector could die in the middle of writing rows, they are not indexed anyway
+        num_rows = os.path.getsize(bin_path) // (DET_SIZE * 4)
+        if num_rows:
+            dets = np.memmap(bin_path, dtype=np.float32, mode='r', shape=(num_rows, DET_SIZE))
+        else:  # empty file can't be mapped
+            dets = np.zeros((0, DET_SIZE), dtype=np.float32)
+        for line in index:
+            path, start, count = line.rstrip('\n').split('\t')
+            output.append((path, dets[int(start): int(start) + int(count)]))
+    output.extend(map(line_to_dets, read_index_lines(os.path.join(folder, META))))
     return output
 
 
+def write_dets_args(folder: str, detector_args: str) -> None:
+    with open(os.path.join(folder, DETS_ARGS), 'w') as f:
+        f.write(detector_args)
+
+
+def read_dets_args(folder: str) -> Optional[str]:
+    """ Args the output in <folder> is produced with, None if they are unknown. """
+    if not os.path.exists(os.path.join(folder, DETS_ARGS)):
+        return None
+    with open(os.path.join(folder, DETS_ARGS)) as f:
+        return f.read()
+
+
+def remove_dets(folder: str) -> None:
+    for name in (DETS_BIN, DETS_INDEX, META, DETS_ARGS):
+        if os.path.exists(os.path.join(folder, name)):
+            os.remove(os.path.join(folder, name))
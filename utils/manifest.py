@@ -0,0 +1,94 @@
+"""
+ File name   : manifest.py
+ Description : Per-image cache of detector results, so runs are resumable and incremental.
+
+ Date created : 18.10.2026
+"""
+
+import os
+import sqlite3
+import hashlib
+import threading
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+from utils.io import DET_SIZE
+
+
+QUERY_CHUNK = 500  # paths per query, SQLite allows 999 parameters in a statement
+
+
+def file_stamp(path: str, content_hash: bool = False) -> str:
+    """ Identity of image file content: "<size>:<mtime_ns>" or blake2b of the bytes. """
+    if content_hash:
+        h = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
+    st = os.stat(path)
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+
+class Manifest:
+    """
+    Results of detectors (float32 rows of binary detector output per image) keyed by (detector, detector args, image path).
+    A result is valid only while the image stamp is the same as the one it was computed for.
+    """
+    def __init__(self, path: str, content_hash: bool = False):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.content_hash = content_hash
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS detections ("
+            "detector TEXT, args TEXT, path TEXT, stamp TEXT, dets BLOB, "
+            "PRIMARY KEY (detector, args, path))")
+        self._conn.commit()
+
+    def stamps(self, img_paths: Iterable[str]) -> Dict[str, str]:
+        return {p: file_stamp(p, self.content_hash) for p in img_paths}
+
+    def _select(self, columns: str, detector: str, args: str, paths: Iterable[str]) -> Iterator[tuple]:
+        """ <columns> of results for <paths> only: cost depends on number of paths, not on size of the cache. """
+        paths = list(paths)
+        for i in range(0, len(paths), QUERY_CHUNK):
+            chunk = paths[i: i + QUERY_CHUNK]
+            with self._lock:  # rows are fetched under the lock, but yielded without it
+                rows = self._conn.execute(
+                    f"SELECT {columns} FROM detections WHERE detector = ? AND args = ? "
+                    f"AND path IN ({', '.join('?' * len(chunk))})", (detector, args, *chunk)).fetchall()
+            yield from rows
+
+    def missing(self, detector: str, args: str, stamps: Dict[str, str]) -> List[str]:
+        """ Images from <stamps> which have no valid result of <detector> yet. """
+        cached = dict(self._select('path, stamp', detector, args, stamps))
+        return [p for p, stamp in stamps.items() if cached.get(p) != stamp]
+
+    def add(self, detector: str, args: str, dets: Iterable[Tuple[str, np.ndarray]], stamps: Dict[str, str] = None) -> int:
+        """ Store (path, rows) of detector output. Stamps are taken from <stamps> or from the files on disk. """
+        rows = []
+        for path, det_rows in dets:
+            if stamps and path in stamps:
+                stamp = stamps[path]
+            elif os.path.exists(path):
+                stamp = file_stamp(path, self.content_hash)
+            else:
+                continue
+            rows.append((detector, args, path, stamp, np.ascontiguousarray(det_rows, dtype=np.float32).tobytes()))
+
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO detections VALUES (?, ?, ?, ?, ?)", rows)
+            self._conn.commit()
+        return len(rows)
+
+    def detections(self, detector: str, args: str, stamps: Dict[str, str]) -> Iterator[Tuple[str, np.ndarray]]:
+        """ Valid cached (path, [count, 15] rows) of <detector> for images from <stamps>, read lazily by chunks. """
+        for path, stamp, dets in self._select('path, stamp, dets', detector, args, stamps):
+            if stamps.get(path) == stamp:
+                yield path, np.frombuffer(dets, dtype=np.float32).reshape(-1, DET_SIZE)
+
+    def close(self) -> None:
+        self._conn.close()
@@ -0,0 +1,60 @@
+"""
+ File name   : scheduler.py
+ Description : Run detectors concurrently and split CPU cores between them by cost weights.
+
+ Date created : 18.10.2026
+"""
+
+import os
+import time
+from typing import Callable, Dict, List
+from concurrent.futures import ThreadPoolExecutor
+
+
+def split_cores(weights: Dict[str, float], total: int = 0) -> Dict[str, List[int]]:
+    """
+    Split <total> cores (all available if 0) into contiguous ranges proportional to <weights>.
+    Every job gets at least one core. If there are fewer cores than jobs, ranges wrap around and overlap.
+    """
+    total = total or os.cpu_count() or 1
+    names = list(weights.keys())
+    weight_sum = sum(max(w, 0) for w in weights.values()) or len(names)
+
+    # largest remainder method
+    shares = {n: max(weights[n], 0) / weight_sum * total for n in names}
+    counts = {n: max(1, int(shares[n])) for n in names}
+    left = total - sum(counts.values())
+    for n in sorted(names, key=lambda n: shares[n] - int(shares[n]), reverse=True):
+        if left <= 0:
+            break
+        counts[n] += 1
+        left -= 1
+
+    cores, start = dict(), 0
+    for n in names:
+        cores[n] = [(start + i) % total for i in range(counts[n])]
+        start += counts[n]
+    return cores
+
+
+def cpuset(cores: List[int]) -> str:
+    """ [0, 1, 2, 5] -> "0-2,5" """
+    ranges, cores = [], sorted(set(cores))
+    for c in cores:
+        if ranges and ranges[-1][1] == c - 1:
+            ranges[-1][1] = c
+        else:
+            ranges.append([c, c])
+    return ','.join(f"{a}-{b}" if a != b else str(a) for a, b in ranges)
+
+
+def run_timed(jobs: Dict[str, Callable[[], None]], parallel: bool = True) -> Dict[str, float]:
+    """ Run all jobs (concurrently if <parallel>), wait for all of them and return wall time in seconds of each. """
+    def _timed(job: Callable[[], None]) -> float:
+        tic = time.time()
+        job()
+        return time.time() - tic
+
+    with ThreadPoolExecutor(max_workers=max(len(jobs), 1) if parallel else 1) as pool:
+        futures = {name: pool.submit(_timed, job) for name, job in jobs.items()}
+        return {name: future.result() for name, future in futures.items()}
@@ -0,0 +1,113 @@
+"""
+ File name   : score_index.py
+ Description : Sidecar index of result files with all detections sorted by score, so filtering by any confidence
+               threshold or counting detections over many thresholds is a binary search instead of reading the output.
+
+ <output>.scores.npz:
+    paths      - image paths in order of the output
+    scores     - scores of all detections, ascending
+    dets       - [n, 15] rows "x1 y1 x2 y2 score l1..l10" in the same order
+    image      - image of every detection (position in <paths>)
+    position   - position of every detection among detections of its image
+    max_scores - best score of every image, ascending (-inf for images without detections)
+    source     - size and mtime of the output the index is built from
+
+ Date created : 18.10.2026
+"""
+
+import os
+from typing import Iterable, Iterator, Tuple
+
+import numpy as np
+
+from utils.io import DET_SIZE, iter_log, load_json
+from utils.index import parse_record
+
+
+def score_index_path(output_path: str) -> str:
+    return output_path + '.scores.npz'
+
+
+def _source_stamp(output_path: str) -> np.ndarray:
+    st = os.stat(output_path)
+    return np.array([st.st_size, st.st_mtime_ns], dtype=np.int64)
+
+
+def _iter_rows(output_path: str) -> Iterator[Tuple[str, np.ndarray]]:
+    """ (ipath, [n, 15] rows) of every image of a result file of any format. """
+    if output_path.endswith('.txt'):
+        yield from iter_log(output_path)
+        return
+
+    if output_path.endswith('.jsonl'):
+        with open(output_path) as f:
+            records = [parse_record(line.strip()) for line in f if line.strip()]
+    else:
+        records = load_json(output_path).items()
+    for ipath, detections in records:
+        rows = [list(d['box'][:4]) + [d['score']] + list(d['landmarks']) for d in detections]
+        yield ipath, np.array(rows, dtype=np.float64).reshape(-1, DET_SIZE)
+
+
+def build_score_index(output_path: str) -> int:
+    """ Index detections of an output by score. Returns number of indexed detections. """
+    paths, parts = [], []
+    for ipath, rows in _iter_rows(output_path):
+        paths.append(ipath)
+        parts.append(rows)
+    rows = np.concatenate(parts) if parts else np.zeros((0, DET_SIZE), dtype=np.float64)
+
+    counts = np.array([len(p) for p in parts], dtype=np.int64)
+    starts = np.cumsum(counts) - counts
+    image = np.repeat(np.arange(len(parts), dtype=np.int64), counts)
+    position = np.arange(len(rows)) - np.repeat(starts, counts)
+
+    max_scores = np.full(len(parts), -np.inf)
+    np.maximum.at(max_scores, image, rows[:, 4])
+
+    order = np.argsort(rows[:, 4], kind='stable')
+    np.savez(score_index_path(output_path), paths=np.array(paths, dtype=str), scores=rows[order, 4], dets=rows[order],
+             image=image[order], position=position[order], max_scores=np.sort(max_scores),
+             source=_source_stamp(output_path))
+    return len(rows)
+
+
+class ScoreIndex:
+    """ Detections of an output sorted by score. Arrays are loaded from the index when they are needed first. """
+    def __init__(self, output_path: str):
+        self.data = np.load(score_index_path(output_path))
+        self.scores = self.data['scores']
+
+    @staticmethod
+    def is_fresh(output_path: str) -> bool:
+        """ Index exists and the output didn't change since it was built. """
+        if not os.path.exists(score_index_path(output_path)):
+            return False
+        with np.load(score_index_path(output_path)) as data:
+            return bool(np.array_equal(data['source'], _source_stamp(output_path)))
+
+    @classmethod
+    def load(cls, output_path: str) -> 'ScoreIndex':
+        """ Index of <output_path>, it is (re)built if missing or stale. """
+        if not cls.is_fresh(output_path):
+            build_score_index(output_path)
+        return cls(output_path)
+
+    def count(self, thresholds: Iterable[float]) -> Tuple[np.ndarray, np.ndarray]:
+        """ Numbers of detections and of images with any detection with score >= every threshold. """
+        thresholds = np.asarray(list(thresholds), dtype=self.scores.dtype)
+        max_scores = self.data['max_scores']
+        return len(self.scores) - np.searchsorted(self.scores, thresholds, side='left'), \
+               len(max_scores) - np.searchsorted(max_scores, thresholds, side='left')
+
+    def filter(self, thresh: float) -> Iterator[Tuple[str, np.ndarray]]:
+        """ (ipath, [n, 15] rows with score >= <thresh>) of every image in order of the output. """
+        start = np.searchsorted(self.scores, np.asarray(thresh, dtype=self.scores.dtype), side='left')
+        image, position = self.data['image'][start:], self.data['position'][start:]
+        order = np.lexsort((position, image))
+        rows = self.data['dets'][start:][order]
+
+        paths = self.data['paths']
+        bounds = np.searchsorted(image[order], np.arange(len(paths) + 1), side='left')
+        for i, ipath in enumerate(paths.tolist()):
+            yield ipath, rows[bounds[i]: bounds[i + 1]]
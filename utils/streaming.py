@@ -0,0 +1,87 @@
+"""
+ File name   : streaming.py
+ Description : Aggregate detections per image as soon as all detectors reported it.
+
+ Date created : 18.10.2026
+"""
+
+import os
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from utils.io import DET_SIZE, DETS_BIN, DETS_INDEX, META, line_to_dets
+
+
+class LogFollower:
+    """ Follows a log which is being written by a detector and returns only complete new lines. """
+    def __init__(self, path: str):
+        self.path = path
+        self.offset = 0
+        self.rest = b''
+
+    def read_new(self) -> List[str]:
+        if not os.path.exists(self.path):
+            return []
+        if os.path.getsize(self.path) < self.offset:  # file was recreated
+            self.offset, self.rest = 0, b''
+
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            chunk = f.read()
+            self.offset = f.tell()
+
+        lines = (self.rest + chunk).split(b'\n')
+        self.rest = lines.pop()
+        return [line.decode() + '\n' for line in lines if line.strip()]
+
+
+class DetsFollower:
+    """ Follows output a detector is writing to <folder>: binary rows with their index or text log. """
+    def __init__(self, folder: str):
+        self.bin_path = os.path.join(folder, DETS_BIN)
+        self.index = LogFollower(os.path.join(folder, DETS_INDEX))
+        self.meta = LogFollower(os.path.join(folder, META))
+
+    def read_new(self) -> List[Tuple[str, np.ndarray]]:
+        output = []
+        for line in self.index.read_new():
+            path, start, count = line.rstrip('\n').split('\t')
+            # rows are written before the index line, so they are complete
+            rows = np.fromfile(self.bin_path, dtype=np.float32, count=int(count) * DET_SIZE,
+                               offset=int(start) * DET_SIZE * 4)
+            output.append((path, rows.reshape(-1, DET_SIZE)))
+        output.extend(map(line_to_dets, self.meta.read_new()))
+        return output
+
+
+class StreamingAggregator:
+    """
+    Collects detections of every image from all detectors. When the last of <detectors> reports an image,
+    <on_ready>(img, rows) is called with [n, 15] rows of all detectors and the image is dropped,
+    so only in-flight images are kept in memory.
+    """
+    def __init__(self, detectors: List[str], on_ready: Callable[[str, np.ndarray], None]):
+        self.detectors = set(detectors)
+        self.on_ready = on_ready
+        self.pending: Dict[str, Tuple[set, List[np.ndarray]]] = dict()
+        self.done = 0
+
+    def add(self, detector: str, img: str, rows: np.ndarray) -> None:
+        reported, parts = self.pending.setdefault(img, (set(), []))
+        reported.add(detector)
+        parts.append(rows)
+
+        if reported >= self.detectors:
+            del self.pending[img]
+            self._ready(img, parts)
+
+    def flush(self) -> None:
+        """ Aggregate images some detectors never reported (e.g. detector crashed). """
+        for img, (_, parts) in list(self.pending.items()):
+            self._ready(img, parts)
+        self.pending.clear()
+
+    def _ready(self, img: str, parts: List[np.ndarray]) -> None:
+        self.on_ready(img, np.concatenate(parts).reshape(-1, DET_SIZE))
+        self.done += 1
@@ -6,39 +6,27 @@
  Author:  Ihar Khakholka
 """
 
-from typing import List
+from typing import Iterable
 from collections import defaultdict
 
+from utils.io import parse_log, iter_log, split_dets
 
-def log_to_json(data: List[str]) -> dict:
-    output = defaultdict(list)
-
-    det_size = 1 + 4 + 10
 
-    for line in data:
-        img = line.split(' ')[0]
-        count = int(line.split(' ')[1])
-        line = line.split("$d")[1].strip().split(' ')
+def log_to_json(data: Iterable[str]) -> dict:
+    return _rows_to_json(parse_log(data))
 
-        if not count:
-            continue
+def log_file_to_internal(log_file: str) -> dict:
+    return _rows_to_json(iter_log(log_file))
 
-        for i in range(count):
-            det_raw = line[i * det_size: (i + 1) * det_size]
-            landmarks = [float(p) for p in det_raw[5:]]
-            x1 = min(int(det_raw[1]), int(det_raw[3]))
-            x2 = max(int(det_raw[1]), int(det_raw[3]))
-            y1 = min(int(det_raw[2]), int(det_raw[4]))
-            y2 = max(int(det_raw[2]), int(det_raw[4]))
-            score = float(det_raw[0])
+def _rows_to_json(parsed) -> dict:
+    output = defaultdict(list)
 
-            detection = {"box": [x1,y1,x2,y2], "score": score, "landmarks": landmarks}
+    for img, rows in parsed:
+        if not len(rows):
+            continue
 
-            output[img].append(detection)
+        detections, landmarks = split_dets(rows)
+        boxes = detections[:, :4].astype(int).tolist()
+        for box, score, lndms in zip(boxes, detections[:, 4].tolist(), landmarks.tolist()):
+            output[img].append({"box": box, "score": score, "landmarks": lndms})
     return output
-
-def log_file_to_internal(log_file: str) -> dict:
-    with open(log_file) as f:
-        data = f.readlines()
-    return log_to_json(data)
-
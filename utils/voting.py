@@ -6,35 +6,219 @@
  Author:  Ihar Khakholka
 """
 
-from typing import List, Union, Tuple
+from functools import partial
+from typing import Iterator, List, Union, Tuple
 
 import numpy as np
 
 
+# images with more boxes are voted over sparse neighbours: IoU matrix is quadratic in time and memory
+SPARSE_MIN_BOXES = 1024
+# images voted in lockstep at once have at most this many IoU cells (num * size * size), 0.5MB per [num, size, size] array
+LOCKSTEP_CELLS = 1 << 16
+
 
 def aggregate_detections(detections: Union[np.ndarray, List[list]], landmarks: Union[List[list], np.ndarray],
               thresh_iou: List[float], min_votes: List[int]) -> Tuple[np.ndarray, np.ndarray]:
     """"
     Function to aggregate detections: supress extra ones and keep ones with <min_votes> and with preferably landmarks.
-
+    IoU matrix is computed once and reused on every <thresh_iou> level.
     """
-    def _not_empty_landmarks(lndms: List[float]) -> bool:
-        return any([p >= 0 for p in lndms])
-
     assert len(thresh_iou) == len(min_votes)
 
-    detections = np.array(detections)
-    landmarks = np.array(landmarks)
+    detections = np.array(detections, dtype=np.float64).reshape(-1, 5)
+    landmarks = np.array(landmarks, dtype=np.float64).reshape(-1, 10)
 
     if not len(thresh_iou):
         return detections, landmarks
 
-    landmarks_mask = list(map(_not_empty_landmarks, landmarks))
+    idxs = _vote_levels(detections, (landmarks >= 0).any(axis=1), thresh_iou, min_votes)
+    return detections[idxs], landmarks[idxs]
+
+
+def aggregate_batch(detections: np.ndarray, landmarks: np.ndarray, segments: np.ndarray,
+                    thresh_iou: List[float], min_votes: List[int], max_batched: int = 64) -> List[np.ndarray]:
+    """
+    The same voting as aggregate_detections for many images at once. Detections of image i are
+    <detections>[segments[i]: segments[i + 1]]. Returns indices of kept detections inside every image, in the order
+    aggregate_detections returns them.
+    Images with up to <max_batched> detections are padded to buckets of the same size and voted in lockstep by chunks
+    of LOCKSTEP_CELLS, so memory doesn't depend on number of images; bigger ones are voted one by one.
+    """
+    assert len(thresh_iou) == len(min_votes)
+
+    detections = np.asarray(detections, dtype=np.float64).reshape(-1, 5)
+    landmarks_mask = (np.asarray(landmarks).reshape(-1, 10) >= 0).any(axis=1)
+    segments = np.asarray(segments, dtype=np.int64)
+    counts = np.diff(segments)
+
+    keeps: List[np.ndarray] = [None] * len(counts)
+    if not len(thresh_iou):
+        return [np.arange(count) for count in counts]
+
+    for img in np.flatnonzero(counts > max_batched):
+        start, end = segments[img], segments[img + 1]
+        keeps[img] = _vote_levels(detections[start: end], landmarks_mask[start: end], thresh_iou, min_votes)
+
+    # buckets of power of 2 sizes, so padding is less than a half
+    sizes = np.where(counts > 0, 1 << np.ceil(np.log2(np.maximum(counts, 1))).astype(np.int64), 0)
+    for size in np.unique(sizes[counts <= max_batched]):
+        imgs = np.flatnonzero((sizes == size) & (counts <= max_batched))
+        if not size:
+            for img in imgs:
+                keeps[img] = np.empty(0, dtype=np.int64)
+            continue
+        chunk = max(1, LOCKSTEP_CELLS // (size * size))
+        for i in range(0, len(imgs), chunk):
+            part = imgs[i: i + chunk]
+            picks = _lockstep_vote(detections, landmarks_mask, segments[part], counts[part], size, thresh_iou, min_votes)
+            for img, pick in zip(part, picks):
+                keeps[img] = pick
+
+    return keeps
+
+
+def _vote_levels(detections: np.ndarray, landmarks_mask: np.ndarray, thresh_iou: List[float],
+                 min_votes: List[int]) -> np.ndarray:
+    """ Indexes of <detections> left after all levels. Crowd images are voted over sparse neighbours instead of IoU matrix. """
+    if len(detections) >= SPARSE_MIN_BOXES and min(thresh_iou) > 0:
+        vote = partial(_greedy_vote_sparse, *iou_pairs(detections))
+    else:
+        vote = partial(_greedy_vote, iou_matrix(detections))
+
+    idxs = np.arange(len(detections))
+    for thresh, votes in zip(thresh_iou, min_votes):
+        keep = vote(idxs, detections[idxs, 4], landmarks_mask[idxs], thresh, votes)
+        idxs = idxs[keep]
+    return idxs
+
+
+def _lockstep_vote(detections: np.ndarray, landmarks_mask: np.ndarray, starts: np.ndarray, counts: np.ndarray,
+                   size: int, thresh_iou: List[float], min_votes: List[int]) -> List[np.ndarray]:
+    """
+    _greedy_vote of every image padded to <size> boxes at once: step k visits the k-th most confident box of all images.
+    Images don't share boxes, so every image gets exactly its own greedy result.
+    """
+    num, rows = len(starts), np.arange(len(starts))[:, None]
+    image = np.broadcast_to(rows, (num, size))
+    valid = np.arange(size)[None, :] < counts[:, None]
+    gather = np.where(valid, starts[:, None] + np.arange(size)[None, :], 0)
+
+    boxes = detections[gather]
+    scores = boxes[:, :, 4]
+    lm = landmarks_mask[gather]
+
+    # the same formula as iou_matrix
+    start_x, start_y, end_x, end_y = (boxes[:, :, i] for i in range(4))
+    areas = (end_x - start_x) * (end_y - start_y)
+    w = np.maximum(0.0, np.minimum(end_x[:, :, None], end_x[:, None, :]) - np.maximum(start_x[:, :, None], start_x[:, None, :]) + 1)
+    h = np.maximum(0.0, np.minimum(end_y[:, :, None], end_y[:, None, :]) - np.maximum(start_y[:, :, None], start_y[:, None, :]) + 1)
+    intersection = w * h
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ious = intersection / (areas[:, :, None] + areas[:, None, :] - intersection)
+
+    active = valid
+    sequence = np.broadcast_to(np.arange(size), (num, size))  # order of boxes on the level: input, then picks
+    for thresh, votes in zip(thresh_iou, min_votes):
+        # ascending score order of active boxes, inactive ones go first and are never visited
+        order = np.lexsort((sequence.ravel(), np.where(active, scores, -np.inf).ravel(), image.ravel()))
+        order = order.reshape(num, size) - rows * size
+        position = np.empty_like(order)
+        position[rows, order] = np.arange(size)[None, :]
+
+        # preference of the voters: with landmarks, then more confident, then earlier in order
+        preference = np.empty(num * size, dtype=np.int64)
+        preference[np.lexsort((position.ravel(), -scores.ravel(), ~lm.ravel(), image.ravel()))] = np.arange(num * size)
+        preference = np.where(active, preference.reshape(num, size), np.iinfo(np.int64).max)
+
+        alive = active.copy()
+        picked = np.full((num, size), -1, dtype=np.int64)
+        for step, k in enumerate(range(size - 1, -1, -1)):
+            index = order[:, k]
+            visit = alive[rows[:, 0], index]
+            if not visit.any():
+                continue
+            suppressed = alive & (ious[rows[:, 0], index] >= thresh)
+            suppressed[rows[:, 0], index] = True  # degenerate boxes can have IoU < 1 with themselves
+            suppressed &= visit[:, None]
+
+            chosen = np.where(suppressed, preference, np.iinfo(np.int64).max).argmin(axis=1)
+            win = visit & (suppressed.sum(axis=1) >= votes)
+            picked[rows[win, 0], chosen[win]] = step
+            alive &= ~suppressed
+
+        active = picked >= 0
+        sequence = np.where(active, picked, size)
+
+    return [np.flatnonzero(active[i])[np.argsort(sequence[i][active[i]])] for i in range(num)]
+
+
+def _sweep(detections: np.ndarray, block: int) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Boxes are swept by x1 in blocks of <block>, every block is paired only with boxes which start before it ends
+    (earlier ones were paired by previous blocks). Yields (rows, cols, intersection, iou) of every block.
+    """
+    start_x, start_y, end_x, end_y = (detections[:, i] for i in range(4))
+    areas = (end_x - start_x) * (end_y - start_y)
+
+    by_x = start_x.argsort(kind='stable')
+    sorted_x = start_x[by_x]
+    for i in range(0, len(by_x), block):
+        rows = by_x[i: i + block]
+        cols = by_x[i: np.searchsorted(sorted_x, end_x[rows].max() + 1, side='left')]
+
+        w = np.minimum(end_x[rows, None], end_x[None, cols])
+        w -= np.maximum(start_x[rows, None], start_x[None, cols])
+        w += 1
+        np.maximum(w, 0.0, out=w)
+        h = np.minimum(end_y[rows, None], end_y[None, cols])
+        h -= np.maximum(start_y[rows, None], start_y[None, cols])
+        h += 1
+        np.maximum(h, 0.0, out=h)
+        intersection = np.multiply(w, h, out=w)
+
+        union = np.add(areas[rows, None], areas[None, cols], out=h)
+        union -= intersection
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ious = intersection / union
 
-    keep = nms_landmarks(detections, landmarks_mask, thresh_iou[0], min_votes[0])
+        yield rows, cols, intersection, ious
 
-    return aggregate_detections(detections[keep], landmarks[keep], thresh_iou[1:], min_votes[1:])
 
+def iou_matrix(detections: np.ndarray, block: int = 128) -> np.ndarray:
+    """
+    Pairwise IoU of [x1, y1, x2, y2, ...] boxes with the same (+1 for intersection) convention as nms_landmarks.
+    Only pairs which can intersect are computed, the rest stay 0.
+    """
+    ious = np.zeros((len(detections), len(detections)))
+    for rows, cols, _, block_ious in _sweep(detections, block):
+        ious[np.ix_(rows, cols)] = block_ious
+        ious[np.ix_(cols, rows)] = block_ious.T
+    return ious
+
+
+def iou_pairs(detections: np.ndarray, block: int = 256) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Sparse iou_matrix for crowd images: only intersecting pairs are kept, so memory is linear in number of neighbours.
+    Neighbours of box i are neighbours[indptr[i]: indptr[i + 1]] with IoUs ious[indptr[i]: indptr[i + 1]].
+    """
+    firsts, seconds, values = [], [], []
+    for rows, cols, intersection, block_ious in _sweep(detections, block):
+        # pairs inside the block are met twice and box itself is not its own neighbour
+        upper = np.arange(len(cols))[None, :] > np.arange(len(rows))[:, None]
+        r, c = np.nonzero((intersection > 0) & upper)
+        firsts.append(rows[r])
+        seconds.append(cols[c])
+        values.append(block_ious[r, c])
+
+    firsts, seconds, values = (np.concatenate(x) if x else np.empty(0) for x in (firsts, seconds, values))
+    firsts, seconds = np.concatenate([firsts, seconds]).astype(np.int64), np.concatenate([seconds, firsts]).astype(np.int64)
+    values = np.concatenate([values, values])
+
+    by_box = firsts.argsort(kind='stable')
+    indptr = np.zeros(len(detections) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(firsts, minlength=len(detections)), out=indptr[1:])
+    return indptr, seconds[by_box], values[by_box]
 
 
 def nms_landmarks(detections: np.ndarray, landmarks_mask: List[bool], thresh_iou: float, min_votes: int = 1) -> List[int]:
@@ -51,68 +235,70 @@ def nms_landmarks(detections: np.ndarray, landmarks_mask: List[bool], thresh_iou
     Returns:
         A list boxes idxs to be selected
     """
-    landmarks_mask = np.array(landmarks_mask)
-
-    # we extract coordinates for every
-    # prediction box present in P
-    start_x = detections[:, 0]
-    start_y = detections[:, 1]
-    end_x = detections[:, 2]
-    end_y = detections[:, 3]
+    detections = np.asarray(detections, dtype=np.float64).reshape(-1, 5)
+    return _vote_levels(detections, np.array(landmarks_mask, dtype=bool).reshape(-1), [thresh_iou], [min_votes]).tolist()
 
-    # we extract the confidence scores as well
-    scores = detections[:, 4]
-
-    # calculate area of every block in P
-    areas = (end_x - start_x) * (end_y - start_y)
 
-    # sort the prediction boxes in P
-    # according to their confidence scores
-    order = scores.argsort()
+def _greedy_vote(ious: np.ndarray, idxs: np.ndarray, scores: np.ndarray, landmarks_mask: np.ndarray,
+                 thresh_iou: float, min_votes: int) -> np.ndarray:
+    """
+    Voting among boxes <idxs> of <ious> matrix (<scores> and <landmarks_mask> are given for them), returns positions in <idxs>.
+    Boxes are visited from the most confident one. Every not suppressed box suppresses all not suppressed boxes
+    with IoU >= <thresh_iou> (itself included) and they vote: the most confident box with landmarks among them is kept
+    if there are at least <min_votes> of them.
+    """
+    order, preference = _visit_order(scores, landmarks_mask)
 
-    # initialise an empty list for
-    # filtered prediction boxes
+    subset = len(idxs) != len(ious)
+    alive = np.ones(len(order), dtype=bool)
     keep = []
+    for index in order[::-1]:
+        if not alive[index]:
+            continue
+        row = ious[idxs[index], idxs] if subset else ious[index]
+        suppressed = alive & (row >= thresh_iou)
+        suppressed[index] = True  # degenerate boxes can have IoU < 1 with themselves
+        candidates = np.flatnonzero(suppressed)
 
-    while len(order) > 0:
-
-        # The index of largest confidence score
-        index = order[-1]
-
-        # Compute coordinates of intersection-over-union(IOU)
-        x1 = np.maximum(start_x[index], start_x[order])
-        x2 = np.minimum(end_x[index], end_x[order])
-        y1 = np.maximum(start_y[index], start_y[order])
-        y2 = np.minimum(end_y[index], end_y[order])
-
-        # Compute areas of intersection-over-union
-        w = np.maximum(0.0, x2 - x1 + 1)
-        h = np.maximum(0.0, y2 - y1 + 1)
-        intersection = w * h
-
-        # Compute the ratio between intersection and union
-        ratio = intersection / (areas[index] + areas[order] - intersection)
+        if len(candidates) >= min_votes:
+            keep.append(candidates[preference[candidates].argmin()])
+        alive[candidates] = False
 
-        # split by ious
-        candidates = np.where(ratio >= thresh_iou)
-        left = np.where(ratio < thresh_iou)
+    return np.array(keep, dtype=np.int64)
 
-        # Choose the most confident with landmarks
 
-        candidate_indexes = order[candidates]
+def _greedy_vote_sparse(indptr: np.ndarray, neighbours: np.ndarray, ious: np.ndarray, idxs: np.ndarray,
+                        scores: np.ndarray, landmarks_mask: np.ndarray, thresh_iou: float, min_votes: int) -> np.ndarray:
+    """ _greedy_vote over iou_pairs, every box looks only at its neighbours. <thresh_iou> must be > 0. """
+    order, preference = _visit_order(scores, landmarks_mask)
 
-        # sort first by confidence then by landmarks. The sorted() alg is stable.
-        candidate_indexes = sorted(candidate_indexes, key=lambda i: scores[i], reverse=True)
-        candidate_indexes = sorted(candidate_indexes, key=lambda i: landmarks_mask[i], reverse=True)
-
-        # update index with one with landmarks
-        index = candidate_indexes[0]
-
-        # save result
-        if len(candidate_indexes) >= min_votes:
-            keep.append(index)
-
-        # remove supressed boxes
-        order = order[left]
-
-    return keep
\ No newline at end of file
+    local = np.full(len(indptr) - 1, -1, dtype=np.int64)
+    local[idxs] = np.arange(len(idxs))
+    alive = np.ones(len(order), dtype=bool)
+    keep = []
+    for index in order[::-1]:
+        if not alive[index]:
+            continue
+        start, end = indptr[idxs[index]], indptr[idxs[index] + 1]
+        candidates = local[neighbours[start: end]]
+        candidates = candidates[(candidates >= 0) & (ious[start: end] >= thresh_iou)]
+        candidates = np.append(candidates[alive[candidates]], index)
+
+        if len(candidates) >= min_votes:
+            keep.append(candidates[preference[candidates].argmin()])
+        alive[candidates] = False
+
+    return np.array(keep, dtype=np.int64)
+
+
+def _visit_order(scores: np.ndarray, landmarks_mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """ Ascending visit order of boxes and preference rank of voters (lower is better). """
+    # stable: boxes with equal scores are visited in the same order by aggregate_batch
+    order = scores.argsort(kind='stable')
+    position = np.empty(len(order), dtype=np.int64)
+    position[order] = np.arange(len(order))
+
+    # preference of the voters: with landmarks, then more confident, then earlier in <order>
+    preference = np.empty(len(order), dtype=np.int64)
+    preference[np.lexsort((position, -scores, ~landmarks_mask))] = np.arange(len(order))
+    return order, preference
@@ -0,0 +1,51 @@
+"""
+ File name   : workers.py
+ Description : Client side of long-lived detector workers (see detectors/*/worker.py for the protocol).
+
+ Date created : 18.10.2026
+"""
+
+import os
+import json
+import socket
+from typing import Optional
+
+
+SOCKETS_DIR = "sockets"
+CONTAINER_SOCKETS_DIR = "/root/sockets"
+
+
+def worker_name(detector: str) -> str:
+    return f"detanator_{detector}"
+
+
+def socket_path(detector: str, sockets_dir: str = SOCKETS_DIR) -> str:
+    return os.path.join(os.path.abspath(sockets_dir), f"{detector}.sock")
+
+
+def request(path: str, payload: dict, timeout: Optional[float] = None) -> dict:
+    """ Send one request to the worker listening on <path> and wait for its response. """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        with sock.makefile('rwb') as stream:
+            stream.write((json.dumps(payload) + '\n').encode())
+            stream.flush()
+            line = stream.readline()
+
+    if not line:
+        raise RuntimeError(f"Worker ({path}) closed connection without response!!!")
+    response = json.loads(line)
+    if response.get("status") != "ok":
+        raise RuntimeError(f"Worker ({path}) failed: {response.get('error')}")
+    return response
+
+
+def is_alive(path: str, timeout: float = 1.0) -> bool:
+    if not os.path.exists(path):
+        return False
+    try:
+        request(path, {"cmd": "ping"}, timeout=timeout)
+    except (OSError, RuntimeError, ValueError):
+        return False
+    return True
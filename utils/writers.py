@@ -0,0 +1,133 @@
+"""
+ File name   : writers.py
+ Description : Writers of aggregated detections which emit every image as soon as it is ready.
+
+ Date created : 18.10.2026
+"""
+
+import json
+from typing import List
+
+import numpy as np
+
+from utils.index import path_hash, save_index
+
+try:
+    import orjson  # optional: serializes numpy arrays without creating python floats
+except ImportError:
+    orjson = None
+
+
+def dumps(obj) -> str:
+    """ Compact JSON, the same with and without orjson. """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def detections_to_json(bboxes: np.ndarray, kpss: np.ndarray) -> List[dict]:
+    """ [{"box": [...], "score": .., "landmarks": [...]}, ...] ready for dumps. """
+    bboxes = np.ascontiguousarray(bboxes, dtype=np.float64).reshape(-1, 5)
+    if not len(bboxes):
+        return []
+    kpss = np.ascontiguousarray(kpss, dtype=np.float64).reshape(len(bboxes), -1)
+    if orjson is not None:  # rows are serialized as arrays
+        return [{"box": d[:4], "score": float(d[4]), "landmarks": l} for d, l in zip(bboxes, kpss)]
+    return [{"box": d[:4], "score": d[4], "landmarks": l} for d, l in zip(bboxes.tolist(), kpss.tolist())]
+
+
+class _RecordFile:
+    """ Result file with a record per line. With <index> offsets of records are saved to sidecar index on close. """
+    def __init__(self, path: str, index: bool = False):
+        self.path = path
+        self.f = open(path, 'wb')
+        self.offset = 0
+        self.entries = [] if index else None
+
+    def write(self, prefix: str, ipath: str, record: str) -> None:
+        prefix, record = prefix.encode(), record.encode()
+        self.f.write(prefix + record)
+        if self.entries is not None:
+            self.entries.append((path_hash(ipath), self.offset + len(prefix), len(record)))
+        self.offset += len(prefix) + len(record)
+
+    def close(self, suffix: str = '') -> None:
+        self.f.write(suffix.encode())
+        self.f.close()
+        if self.entries is not None:
+            save_index(self.path, self.entries)
+
+
+class LogWriter:
+    """ <log> format: "path count $d conf x1 y1 x2 y2 l1..l10 ..." line per image. """
+    ext = '.txt'
+
+    def __init__(self, path: str, index: bool = False, keep_empty: bool = True):
+        self.f = _RecordFile(path, index)
+        self.keep_empty = keep_empty
+        self.first = True
+
+    def write(self, ipath: str, bboxes: np.ndarray, kpss: np.ndarray) -> None:
+        if not len(bboxes) and not self.keep_empty:
+            return
+        line = [ipath, str(len(bboxes)), '$d']
+        for i in range(len(bboxes)):
+            conf = bboxes[i][-1]
+            bbox = bboxes[i][:-1]
+            bbox = list(map(int, bbox))
+            bbox = list(map(str, bbox))
+
+            landmarks = np.array(kpss[i]).astype(int).flatten()
+            landmarks = list(map(str, landmarks))
+            line.append(str(conf))
+            line.extend(bbox)
+            line.extend(landmarks)
+
+        self.f.write('' if self.first else '\n', ipath, ' '.join(line))
+        self.first = False
+
+    def close(self) -> None:
+        self.f.close()
+
+
+class DatasetWriter:
+    """ <dataset> format: {"path": [{"box": [...], "score": .., "landmarks": [...]}, ...], ...}. Images without detections are skipped unless <keep_empty>. """
+    ext = '.json'
+
+    def __init__(self, path: str, index: bool = False, keep_empty: bool = False):
+        self.f = _RecordFile(path, index)
+        self.keep_empty = keep_empty
+        self.first = True
+
+    def write(self, ipath: str, bboxes: np.ndarray, kpss: np.ndarray) -> None:
+        if not len(bboxes) and not self.keep_empty:
+            return
+        items = detections_to_json(bboxes, kpss)
+        self.f.write('{\n' if self.first else ',\n', ipath, dumps(ipath) + ': ' + dumps(items))
+        self.first = False
+
+    def close(self) -> None:
+        self.f.close('{}' if self.first else '\n}')
+
+
+class JsonlWriter:
+    """ <jsonl> format: {"path": "...", "detections": [<the same as dataset>]} line per image. Images without detections are skipped unless <keep_empty>. """
+    ext = '.jsonl'
+
+    def __init__(self, path: str, index: bool = False, keep_empty: bool = False):
+        self.f = _RecordFile(path, index)
+        self.keep_empty = keep_empty
+        self.first = True
+
+    def write(self, ipath: str, bboxes: np.ndarray, kpss: np.ndarray) -> None:
+        if not len(bboxes) and not self.keep_empty:
+            return
+        record = dumps({"path": ipath, "detections": detections_to_json(bboxes, kpss)})
+        self.f.write('' if self.first else '\n', ipath, record)
+        self.first = False
+
+    def close(self) -> None:
+        self.f.close('' if self.first else '\n')
+
+
+WRITERS = {'dataset': DatasetWriter, 'jsonl': JsonlWriter, 'log': LogWriter}